@@ -1,59 +1,345 @@
 #!/usr/bin/python
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
 import configparser
+import contextlib
 import datetime
 import email
 import email.header
 import email.mime.text
+import email.parser
+import email.policy
+import email.utils
+import glob
+import html.parser
 import imaplib
+import itertools
+import json
 import os
+import queue
+import random
 import re
+import signal
 import smtplib
+import socket
+import sqlite3
+import ssl
 import sys
+import tempfile
+import threading
+import time
 from _socket import gaierror
 
-config = None
-config_file_path = "autoresponder.config.ini"
-incoming_mail_server = None
-outgoing_mail_server = None
-statistics = {
-    "start_time": datetime.datetime.now(),
-    "mails_loading_error": 0,
-    "mails_total": 0,
-    "mails_processed": 0,
-    "mails_in_trash": 0,
-    "mails_wrong_sender": 0
-}
+# imaplib does not know the MOVE command (RFC 6851) yet
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+
+# errors after which the daemon reconnects to the IMAP server
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+# seconds to wait before retrying a failed reconnect, doubled on every attempt
+RECONNECT_DELAY_MIN = 5
+RECONNECT_DELAY_MAX = 300
+# replies are sent as bytes with the line endings required by SMTP
+SMTP_POLICY = email.policy.compat32.clone(linesep='\r\n')
+# maximum length of a single response line read by the asyncio engine, e.g. the result of a large SEARCH
+ASYNC_STREAM_LIMIT = 2 ** 24
+# seconds to wait before resending a reply after a temporary SMTP failure, doubled on every attempt
+SMTP_RETRY_DELAY = 2
+
+# headers that are fetched before deciding whether an email gets replied to
+FETCH_HEADER_ITEMS = ("(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS "
+                      "(FROM REPLY-TO SUBJECT DATE MESSAGE-ID MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING "
+                      "AUTO-SUBMITTED PRECEDENCE LIST-ID X-AUTO-RESPONSE-SUPPRESS)])")
+# literals larger than this many bytes, like the body of a huge email, are downloaded into a temporary file
+FETCH_SPOOL_SIZE = 2 ** 20
+
+# number of recipients whose last reply is kept in memory per account, the others are looked up in the state file
+REPLY_CACHE_SIZE = 10000
+# number of accounts processed at the same time in multi-account mode, unless set with --workers
+DEFAULT_WORKERS = 4
+
+# upper bounds in seconds of the buckets of the latency histograms
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# the histograms that are recorded and the name of the label telling their values apart
+METRICS_HISTOGRAMS = {'phase': 'phase', 'imap_command': 'command', 'smtp_command': 'command'}
+
+
+class Account:
+    """The configuration, connections and state of one email account, so a single process can serve several."""
+
+    def __init__(self, config_file_path, name=None):
+        self.config_file_path = config_file_path
+        # output of an account is prefixed with its name in multi-account mode
+        self.log_prefix = "[" + name + "] " if name else ""
+        self.config = None
+        self.incoming_mail_server = None
+        self.outgoing_mail_servers = []
+        self.delivery_queue = None
+        self.delivery_results = queue.Queue()
+        self.delivery_workers = []
+        self.reply_skeleton = {}
+        self.trash_queue = []
+        self.state_database = None
+        # the time of the last reply to recipients, or None if they didn't get one, least recently used first
+        self.reply_cache = collections.OrderedDict()
+        # token buckets of the send rate limits and the number of replies deferred to the outbox
+        self.send_rate = []
+        self.outbox_size = 0
+        self.inbox_state = {
+            "uidvalidity": None,
+            "last_uid": 0,
+            "examined_uid": 0,
+            "unfinished_uids": set(),
+            "retry_uids": {}
+        }
+        self.metrics = Metrics()
+        # set by a signal to stop the daemon after the current pass, only waiting for new emails is interrupted
+        self.stop_requested = False
+        self.waiting_for_emails = False
+        self.statistics = {
+            "start_time": datetime.datetime.now(),
+            "mails_loading_error": 0,
+            "mails_total": 0,
+            "mails_processed": 0,
+            "mails_in_trash": 0,
+            "mails_wrong_sender": 0,
+            "mails_suppressed": 0,
+            "mails_replied_before": 0,
+            "mails_send_error": 0
+        }
+
+
+class AccountError(Exception):
+    """Raised by shutdown_with_error() to stop processing an account without affecting the others."""
+
+
+class Metrics:
+    """Counters and latency histograms of the phases of a run and of the IMAP and SMTP commands.
+
+    Updates are locked, because replies are sent by the delivery threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, label, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {}).get(label)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(METRICS_BUCKETS) + 1)}
+                self.histograms[name][label] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['buckets'][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+
+    @contextlib.contextmanager
+    def timed(self, name, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, label, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return the counters and the histograms with cumulative buckets like {'0.001': 3, ..., '+Inf': 12}."""
+        with self.lock:
+            histograms = {}
+            for (name, labels) in self.histograms.items():
+                histograms[name] = {}
+                for (label, histogram) in labels.items():
+                    bounds = [str(bound) for bound in METRICS_BUCKETS] + ['+Inf']
+                    cumulative_counts = itertools.accumulate(histogram['buckets'])
+                    histograms[name][label] = {'count': histogram['count'], 'sum': round(histogram['sum'], 6),
+                                               'buckets': dict(zip(bounds, cumulative_counts))}
+            return (dict(self.counters), histograms)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
 
 
 def run():
-    get_config_file_path()
-    initialize_configuration()
-    connect_to_mail_servers()
-    check_folder_names()
-    mails = fetch_emails()
-    for mail in mails:
-        process_email(mail)
-    log_statistics()
-    shutdown(0)
-
-
-def get_config_file_path():
     if "--help" in sys.argv or "-h" in sys.argv:
         display_help_text()
-    if "--config-path" in sys.argv and len(sys.argv) >= 3:
-        global config_file_path
-        config_file_path = sys.argv[2]
-    if not os.path.isfile(config_file_path):
-        shutdown_with_error("Configuration file not found. Expected it at '" + config_file_path + "'.")
+    config_file_paths = get_config_file_paths()
+    if len(config_file_paths) > 1:
+        run_accounts(config_file_paths)
+    result = run_account(config_file_paths[0])
+    exit(-1 if result['error'] else 0)
+
+
+def run_accounts(config_file_paths):
+    """Process several accounts in parallel with a pool of threads or processes and report the result of each."""
+    if "--daemon" in sys.argv:
+        print("Error! The daemon mode can only be used with a single configuration file.")
+        exit(-1)
+    workers = get_worker_count(len(config_file_paths))
+    if "--processes" in sys.argv:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with executor:
+        results = list(executor.map(run_account, config_file_paths, [True] * len(config_file_paths)))
+    log_account_results(results)
+    exit(-1 if any(result['error'] for result in results) else 0)
+
+
+def run_account(config_file_path, multi_account=False):
+    """Process the inbox of the account configured in the given file and return a summary of the result."""
+    account = Account(config_file_path, config_file_path if multi_account else None)
+    result = {'account': config_file_path, 'error': None}
+    try:
+        if not os.path.isfile(config_file_path):
+            shutdown_with_error(account, "Configuration file not found. Expected it at '" + config_file_path + "'.")
+        initialize_configuration(account)
+        open_state_database(account)
+        load_send_rate(account)
+        if "--async" in sys.argv:
+            if "--daemon" in sys.argv:
+                shutdown_with_error(account, "The asyncio engine can not be used in daemon mode.")
+            if sys.version_info < (3, 11):
+                # StreamWriter.start_tls() of the SMTP connections is new in Python 3.11
+                shutdown_with_error(account, "The asyncio engine needs Python 3.11 or newer.")
+            run_async(account)
+            log_statistics(account)
+            write_metrics(account)
+        else:
+            with account.metrics.timed('phase', 'connect'):
+                connect_to_mail_servers(account)
+            check_folder_names(account)
+            if "--daemon" in sys.argv:
+                run_daemon(account)
+            else:
+                process_inbox(account)
+                log_statistics(account)
+                write_metrics(account)
+    except AccountError as e:
+        result['error'] = str(e)
+    except Exception as e:
+        # in multi-account mode, an unexpected error must not stop the other accounts
+        if not multi_account:
+            raise
+        log_warning(account, "Unexpected error: '" + cast(e, str) + "'.")
+        result['error'] = "Unexpected error: '" + cast(e, str) + "'."
+    finally:
+        shutdown(account)
+    return result
+
+
+def get_config_file_paths():
+    """Get the configuration files given with --config-path, which can be repeated and can name directories."""
+    paths = [sys.argv[index + 1] for index in range(1, len(sys.argv) - 1) if sys.argv[index] == "--config-path"]
+    if not paths:
+        return ["autoresponder.config.ini"]
+    config_file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            # every .ini file in the directory and every autoresponder.config.ini in its subdirectories
+            config_file_paths.extend(sorted(glob.glob(os.path.join(path, "*.ini")) +
+                                            glob.glob(os.path.join(path, "*", "autoresponder.config.ini"))))
+        else:
+            config_file_paths.append(path)
+    if not config_file_paths:
+        print("Error! No configuration files found in '" + "', '".join(paths) + "'.")
+        exit(-1)
+    return config_file_paths
 
 
-def initialize_configuration():
+def get_worker_count(account_count):
+    if "--workers" not in sys.argv:
+        return min(account_count, DEFAULT_WORKERS)
+    try:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
+    except (IndexError, ValueError):
+        workers = 0
+    if workers < 1:
+        print("Error! The number of workers given with --workers must be a positive number.")
+        exit(-1)
+    return workers
+
+
+def process_inbox(account):
+    delete_expired_state(account)
+    send_deferred_replies(account)
+    mails = fetch_emails(account)
+    with contextlib.closing(process_emails(account)) as steps:
+        mail = None
+        while True:
+            try:
+                step = steps.send(mail)
+            except StopIteration:
+                break
+            mail = None
+            if step == 'next':
+                handle_delivered_replies(account)
+                mail = next(mails, None)
+            elif step == 'move':
+                move_emails_to_trash(account)
+            elif isinstance(step, tuple):
+                # blocks while too many rendered replies are waiting for a free connection
+                account.delivery_queue.put(step[1:])
+            else:
+                time.sleep(step)
+    wait_for_deliveries(account)
+    move_emails_to_trash(account)
+    save_inbox_state(account)
+    save_send_rate(account)
+
+
+def run_daemon(account):
+    """Keep the connections open and process new emails as soon as the IMAP server reports them."""
+    log_debug(account, "Running as daemon")
+    # stop gracefully on SIGTERM just like on Ctrl+C, without leaving a pass halfway
+    signal.signal(signal.SIGTERM, lambda signum, frame: request_stop(account))
+    signal.signal(signal.SIGINT, lambda signum, frame: request_stop(account))
+    try:
+        while not account.stop_requested:
+            try:
+                reset_statistics(account)
+                process_inbox(account)
+                log_statistics(account)
+                write_metrics(account)
+                # the metrics of reconnects and of waiting for new emails go into those of the next pass
+                account.metrics.reset()
+                if account.stop_requested:
+                    break
+                account.waiting_for_emails = True
+                wait_for_new_emails(account)
+            except CONNECTION_ERRORS as e:
+                log_warning(account, "Lost connection to IMAP server: '" + cast(e, str) + "'. Reconnecting.")
+                account.waiting_for_emails = True
+                reconnect_to_imap(account)
+            finally:
+                account.waiting_for_emails = False
+    except KeyboardInterrupt:
+        pass
+    log_debug(account, "Stopping daemon")
+
+
+def request_stop(account):
+    """Stop the daemon once the current pass has sent, journaled and moved its emails."""
+    if account.waiting_for_emails or account.stop_requested:
+        # nothing is left halfway while waiting, and a second signal stops at once
+        raise KeyboardInterrupt
+    log_debug(account, "Stopping daemon after the current pass")
+    account.stop_requested = True
+
+
+def initialize_configuration(account):
     try:
         # Use RawConfigParser to avoid interpolation of special characters like %
         config_file = configparser.RawConfigParser()
-        config_file.read(config_file_path, encoding="UTF-8")
-        global config
-        config = {
+        config_file.read(account.config_file_path, encoding="UTF-8")
+        account.config = {
             'in.user': cast(config_file["login credentials"]["mailserver.incoming.username"], str),
             'in.pw': cast(config_file["login credentials"]["mailserver.incoming.password"], str),
             'out.user': cast(config_file["login credentials"]["mailserver.outgoing.username"], str),
@@ -72,59 +358,249 @@ def initialize_configuration():
         
         # Try to get reply.body, but make it optional
         try:
-            config['reply.body'] = cast(config_file["mail content settings"]["mail.reply.body"], str).strip()
+            account.config['reply.body'] = cast(config_file["mail content settings"]["mail.reply.body"], str).strip()
         except KeyError:
-            config['reply.body'] = ""
+            account.config['reply.body'] = ""
         
+        # Maximum number of characters of the body of incoming emails used for [BODY], 0 for no limit
+        account.config['request.body.max.length'] = read_optional_number(
+            account, config_file, "mail content settings", "mail.request.body.max.length", 0, minimum=0)
+
+        # Seconds during which a recipient doesn't get another reply, 0 to reply to every email
+        account.config['reply.suppression.ttl'] = read_optional_number(
+            account, config_file, "mail content settings", "mail.reply.suppression.ttl", 0, minimum=0)
+
         # Add debug setting with default value False if not specified
         try:
             debug_value = config_file["general settings"]["debug"].lower()
-            config['debug'] = debug_value in ['true', '1', 'yes', 'on']
+            account.config['debug'] = debug_value in ['true', '1', 'yes', 'on']
         except (KeyError, AttributeError):
-            config['debug'] = False
+            account.config['debug'] = False
         
+        # Number of emails to fetch with a single IMAP command, defaults to 50
+        account.config['fetch.chunk.size'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.incoming.fetch.chunk.size", 50)
+
+        # Emails larger than the maximum size are replied to without downloading their body, 0 to disable.
+        # Of the others, only the first bytes of the body are downloaded, 0 to download the complete body.
+        account.config['fetch.max.size'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.incoming.fetch.max.size", 0, minimum=0)
+        account.config['fetch.body.size'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.incoming.fetch.body.size", 65536, minimum=0)
+
+        # Number of parallel SMTP connections and how often to retry sending a reply on temporary failures
+        account.config['out.connections'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.outgoing.smtp.connections", 1)
+        account.config['out.retries'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.outgoing.smtp.retries", 3, minimum=0)
+
+        # Limits of the number of replies sent per minute and per hour, 0 for no limit. Replies that would have to wait
+        # longer than the maximum wait for the limits are deferred to the outbox in the state file.
+        account.config['out.rate.minute'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.outgoing.smtp.rate.per.minute", 0, minimum=0)
+        account.config['out.rate.hour'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.outgoing.smtp.rate.per.hour", 0, minimum=0)
+        account.config['out.rate.max.wait'] = read_optional_number(
+            account, config_file, "mail server settings", "mailserver.outgoing.smtp.rate.max.wait", 30, minimum=0)
+
+        # Settings of the daemon mode: IDLE is re-issued before servers drop idle clients after 30 minutes (RFC 2177),
+        # servers without IDLE support are polled with NOOP
+        account.config['daemon.idle.timeout'] = read_optional_number(
+            account, config_file, "general settings", "daemon.idle.timeout", 1740)
+        account.config['daemon.poll.interval'] = read_optional_number(
+            account, config_file, "general settings", "daemon.poll.interval", 60)
+
+        config_dir = os.path.dirname(os.path.abspath(account.config_file_path))
+
+        # File to remember which emails have been examined already, relative to the config file, empty to disable
+        try:
+            state_file = config_file["general settings"]["state.file"].strip()
+        except KeyError:
+            state_file = "autoresponder.state.sqlite"
+        account.config['state.file'] = os.path.join(config_dir, state_file) if state_file else ""
+        account.config['journal.retention'] = read_optional_number(
+            account, config_file, "general settings", "journal.retention", 2592000)
+        # How often later runs examine an email again that could not be loaded, replied to or moved to trash
+        account.config['email.retries'] = read_optional_number(
+            account, config_file, "general settings", "email.retries", 5, minimum=0)
+
+        # Files to write the metrics of every run to, relative to the config file, empty to disable
+        for key in ('metrics.file', 'metrics.prometheus.file'):
+            try:
+                metrics_file = config_file["general settings"][key].strip()
+            except KeyError:
+                metrics_file = ""
+            account.config[key] = os.path.join(config_dir, metrics_file) if metrics_file else ""
+
+        # Rules for the senders to reply to, replacing the single filter of mail.request.from
+        account.config['request.filter'] = load_sender_filter(account, config_file, config_dir)
+
         # Check for external response body file
-        config_dir = os.path.dirname(os.path.abspath(config_file_path))
         html_file = os.path.join(config_dir, "responseBody.html")
         
         if os.path.isfile(html_file):
             with open(html_file, 'r', encoding='UTF-8') as f:
-                config['reply.body'] = f.read()
-                config['reply.body.is_html'] = True
+                account.config['reply.body'] = f.read()
+                account.config['reply.body.is_html'] = True
         else:
-            config['reply.body.is_html'] = False
+            account.config['reply.body.is_html'] = False
+
+        # Parse the templates only once instead of for every reply
+        account.config['reply.subject.template'] = compile_template(account.config['reply.subject'])
+        account.config['reply.body.template'] = compile_template(account.config['reply.body'])
+
+        # Only download the complete emails if the reply contains their body
+        account.config['reply.needs.body'] = 'BODY' in (
+            get_template_variable_names(account.config['reply.subject.template']) |
+            get_template_variable_names(account.config['reply.body.template']))
+        prepare_reply_skeleton(account)
     except KeyError as e:
-        shutdown_with_error("Configuration file is invalid! (Key not found: " + str(e) + ")")
+        shutdown_with_error(account, "Configuration file is invalid! (Key not found: " + str(e) + ")")
+
+
+def read_optional_number(account, config_file, section, key, default, minimum=1):
+    try:
+        value = int(config_file[section][key])
+    except KeyError:
+        return default
+    except ValueError:
+        shutdown_with_error(account, "Configuration file is invalid! (Value of '" + key + "' is not a number)")
+    if value < minimum:
+        shutdown_with_error(account, "Configuration file is invalid! (Value of '" + key + "' must be at least " +
+                            str(minimum) + ")")
+    return value
+
+
+def load_sender_filter(account, config_file, config_dir):
+    """Compile the rules for the senders to reply to and the senders never to reply to, which are denied by rules
+    starting with '!'. The rules are given in the config file, separated by commas or new lines, or in a file
+    with one rule per line. Commas inside regular expressions like '/^[a-z]{1,3}@/' don't separate rules."""
+    allowed_senders = SenderRules()
+    denied_senders = SenderRules()
+    if account.config['request.from'] not in ('', '*'):
+        allowed_senders.add_substring(account.config['request.from'])
+    rules = re.findall(r'[ \t]*!?[ \t]*/.*?/(?=[ \t]*(?:,|$))|[^,\n]+',
+                       config_file["mail content settings"].get("mail.request.from.rules", ""), re.MULTILINE)
+    rules_file = config_file["mail content settings"].get("mail.request.from.rules.file", "").strip()
+    if rules_file:
+        try:
+            with open(os.path.join(config_dir, rules_file), 'r', encoding='UTF-8') as f:
+                rules += f.read().splitlines()
+        except OSError as e:
+            shutdown_with_error(account, "Could not read sender rules file '" + rules_file + "'. Reason: '" +
+                                str(e) + "'.")
+    for rule in rules:
+        rule = rule.strip()
+        if not rule or rule.startswith('#'):
+            continue
+        try:
+            if rule.startswith('!'):
+                denied_senders.add(rule[1:].strip())
+            else:
+                allowed_senders.add(rule)
+        except re.error as e:
+            shutdown_with_error(account, "Configuration file is invalid! (Sender rule '" + rule + "' is not a valid "
+                                "regular expression: " + str(e) + ")")
+    try:
+        allowed_senders.compile()
+        denied_senders.compile()
+    except re.error as e:
+        shutdown_with_error(account, "Configuration file is invalid! (The regular expressions of the sender rules "
+                            "can't be combined: " + str(e) + ")")
+    return (allowed_senders, denied_senders)
+
+
+def open_state_database(account):
+    if not account.config['state.file']:
+        return
+    try:
+        account.state_database = sqlite3.connect(account.config['state.file'], timeout=30)
+        with account.state_database:
+            account.state_database.execute(
+                "CREATE TABLE IF NOT EXISTS inbox_state "
+                "(inbox TEXT PRIMARY KEY, uidvalidity INTEGER NOT NULL, last_uid INTEGER NOT NULL)")
+            account.state_database.execute(
+                "CREATE TABLE IF NOT EXISTS replies "
+                "(inbox TEXT NOT NULL, recipient TEXT NOT NULL, replied_at REAL NOT NULL, "
+                "PRIMARY KEY (inbox, recipient))")
+            account.state_database.execute(
+                "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, inbox TEXT NOT NULL, "
+                "recipient TEXT NOT NULL, message BLOB NOT NULL, queued_at REAL NOT NULL)")
+            account.state_database.execute(
+                "CREATE TABLE IF NOT EXISTS send_rate (sender TEXT NOT NULL, period INTEGER NOT NULL, "
+                "tokens REAL NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (sender, period))")
+            # the emails whose reply is being sent ('sending') or has been handled ('replied') and which have been
+            # moved to trash ('moved')
+            account.state_database.execute(
+                "CREATE TABLE IF NOT EXISTS journal (inbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL, "
+                "uid INTEGER NOT NULL, message_id TEXT, state TEXT NOT NULL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (inbox, uidvalidity, uid))")
+            account.state_database.execute(
+                "CREATE INDEX IF NOT EXISTS journal_message_id ON journal (inbox, message_id)")
+            # the emails below the highest examined uid that could not be handled and how often that has failed
+            account.state_database.execute(
+                "CREATE TABLE IF NOT EXISTS retries (inbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL, "
+                "uid INTEGER NOT NULL, attempts INTEGER NOT NULL, PRIMARY KEY (inbox, uidvalidity, uid))")
+    except sqlite3.Error as e:
+        shutdown_with_error(account, "Could not open state file '" + account.config['state.file'] + "'. Reason: '" +
+                            str(e) + "'.")
+
 
+def delete_expired_state(account):
+    """Forget replies that no longer suppress anything and journal entries of emails long gone, on every run."""
+    if account.state_database is None:
+        return
+    with account.state_database:
+        account.state_database.execute("DELETE FROM replies WHERE replied_at < ?",
+                                       (time.time() - account.config['reply.suppression.ttl'],))
+        account.state_database.execute("DELETE FROM journal WHERE updated_at < ?",
+                                       (time.time() - account.config['journal.retention'],))
 
-def connect_to_mail_servers():
-    connect_to_imap()
-    connect_to_smtp()
 
+def connect_to_mail_servers(account):
+    connect_to_imap(account)
+    connect_to_smtp(account)
 
-def check_folder_names():
-    (retcode, msg_count) = incoming_mail_server.select(config['folders.inbox'])
+
+def reconnect_to_imap(account):
+    """Re-establish the IMAP connection, retrying with increasing delays until the server is reachable again."""
+    delay = RECONNECT_DELAY_MIN
+    while True:
+        disconnect_from_imap(account)
+        try:
+            do_connect_to_imap(account)
+            log_debug(account, "Successfully reconnected to IMAP server")
+            return
+        except CONNECTION_ERRORS + (imaplib.IMAP4.error,) as e:
+            log_warning(account, "Reconnecting to IMAP server failed: '" + cast(e, str) + "'. Retrying in " +
+                        str(delay) + " seconds.")
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+
+def check_folder_names(account):
+    (retcode, msg_count) = account.incoming_mail_server.select(account.config['folders.inbox'])
     if retcode != "OK":
-        list_available_folders()
-        shutdown_with_error("Inbox folder does not exist: " + config['folders.inbox'])
-    (retcode, msg_count) = incoming_mail_server.select(config['folders.trash'])
+        list_available_folders(account)
+        shutdown_with_error(account, "Inbox folder does not exist: " + account.config['folders.inbox'])
+    (retcode, msg_count) = account.incoming_mail_server.select(account.config['folders.trash'])
     if retcode != "OK":
-        list_available_folders()
-        shutdown_with_error("Trash folder does not exist: " + config['folders.trash'])
+        list_available_folders(account)
+        shutdown_with_error(account, "Trash folder does not exist: " + account.config['folders.trash'])
 
 
-def list_available_folders():
+def list_available_folders(account):
     print("\nAvailable IMAP folders on this server:")
     print("=" * 40)
     try:
         # List all folders
-        retcode, folders = incoming_mail_server.list()
+        retcode, folders = account.incoming_mail_server.list()
         if retcode == 'OK':
             for folder in folders:
                 # Parse folder name from IMAP response
                 folder_str = folder.decode('utf-8')
                 # Debug: show raw folder string
-                log_debug("Raw folder response: " + folder_str)
+                log_debug(account, "Raw folder response: %s", folder_str)
                 
                 # Try different parsing methods
                 folder_name = None
@@ -161,268 +637,1948 @@ def list_available_folders():
         print("Could not list folders: " + str(e))
 
 
-def connect_to_imap():
+def connect_to_imap(account):
     try:
-        log_debug("Connecting to IMAP server " + config['in.host'] + ":" + config['in.port'])
-        do_connect_to_imap()
-        log_debug("Successfully connected to IMAP server")
+        log_debug(account, "Connecting to IMAP server %s:%s", account.config['in.host'], account.config['in.port'])
+        do_connect_to_imap(account)
+        log_debug(account, "Successfully connected to IMAP server")
     except gaierror:
-        shutdown_with_error("IMAP connection failed! Specified host not found.")
+        shutdown_with_error(account, "IMAP connection failed! Specified host not found.")
     except imaplib.IMAP4_SSL.error as e:
-        shutdown_with_error("IMAP login failed! Reason: '" + cast(e.args[0], str, 'UTF-8') + "'.")
+        shutdown_with_error(account, "IMAP login failed! Reason: '" + cast(e.args[0], str, 'UTF-8') + "'.")
     except Exception as e:
-        shutdown_with_error("IMAP connection/login failed! Reason: '" + cast(e, str) + "'.")
+        shutdown_with_error(account, "IMAP connection/login failed! Reason: '" + cast(e, str) + "'.")
 
 
-def do_connect_to_imap():
-    global incoming_mail_server
-    incoming_mail_server = imaplib.IMAP4_SSL(config['in.host'], config['in.port'])
-    (retcode, capabilities) = incoming_mail_server.login(config['in.user'], config['in.pw'])
+def do_connect_to_imap(account):
+    account.incoming_mail_server = SpoolingIMAP4_SSL(account.config['in.host'], account.config['in.port'],
+                                                     account.metrics)
+    (retcode, capabilities) = account.incoming_mail_server.login(account.config['in.user'], account.config['in.pw'])
     if retcode != "OK":
-        shutdown_with_error("IMAP login failed! Return code: '" + cast(retcode, str) + "'.")
+        raise imaplib.IMAP4.error("Return code: '" + cast(retcode, str) + "'")
+    # many servers only advertise extensions like MOVE and UIDPLUS after the login
+    (retcode, capabilities) = account.incoming_mail_server.capability()
+    if retcode == "OK":
+        account.incoming_mail_server.capabilities = tuple(cast(capabilities[-1], str, 'UTF-8').upper().split())
 
 
-def connect_to_smtp():
+def connect_to_smtp(account):
     try:
-        log_debug("Connecting to SMTP server " + config['out.host'] + ":" + config['out.port'])
-        do_connect_to_smtp()
-        log_debug("Successfully connected to SMTP server")
+        log_debug(account, "Connecting to SMTP server %s:%s with %d connections", account.config['out.host'],
+                  account.config['out.port'], account.config['out.connections'])
+        for index in range(account.config['out.connections']):
+            account.outgoing_mail_servers.append(do_connect_to_smtp(account))
+        log_debug(account, "Successfully connected to SMTP server")
+        start_delivery_workers(account)
     except gaierror:
-        shutdown_with_error("SMTP connection failed! Specified host not found.")
+        shutdown_with_error(account, "SMTP connection failed! Specified host not found.")
     except smtplib.SMTPAuthenticationError as e:
-        shutdown_with_error("SMTP login failed! Reason: '" + cast(e.smtp_error, str, 'UTF-8') + "'.")
+        shutdown_with_error(account, "SMTP login failed! Reason: '" + cast(e.smtp_error, str, 'UTF-8') + "'.")
     except Exception as e:
-        shutdown_with_error("SMTP connection/login failed! Reason: '" + cast(e, str) + "'.")
+        shutdown_with_error(account, "SMTP connection/login failed! Reason: '" + cast(e, str) + "'.")
 
 
-def do_connect_to_smtp():
-    global outgoing_mail_server
-    outgoing_mail_server = smtplib.SMTP(config['out.host'], config['out.port'])
+def do_connect_to_smtp(account):
+    outgoing_mail_server = MeteredSMTP(account.config['out.host'], account.config['out.port'], account.metrics)
     outgoing_mail_server.starttls()
-    (retcode, capabilities) = outgoing_mail_server.login(config['out.user'], config['out.pw'])
+    (retcode, capabilities) = outgoing_mail_server.login(account.config['out.user'], account.config['out.pw'])
     if not (retcode == 235 or retcode == 250):
-        shutdown_with_error("SMTP login failed! Return code: '" + str(retcode) + "'.")
-
-
-def fetch_emails():
-    # get the message ids from the inbox folder
-    incoming_mail_server.select(config['folders.inbox'])
-    (retcode, message_indices) = incoming_mail_server.search(None, 'ALL')
-    if retcode == 'OK':
-        messages = []
-        log_debug("Found " + str(len(message_indices[0].split())) + " emails in inbox")
-        for message_index in message_indices[0].split():
-            # get the actual message for the current index
-            (retcode, data) = incoming_mail_server.fetch(message_index, '(RFC822)')
-            if retcode == 'OK':
-                # parse the message into a useful format
-                message = email.message_from_string(data[0][1].decode('utf-8'))
-                (retcode, data) = incoming_mail_server.fetch(message_index, "(UID)")
-                if retcode == 'OK':
-                    mail_uid = parse_uid(cast(data[0], str, 'UTF-8'))
-                    message['mailserver_email_uid'] = mail_uid
-                    messages.append(message)
-                else:
-                    statistics['mails_loading_error'] += 1
-                    log_warning("Failed to get UID for email with index '" + message_index + "'.")
+        raise smtplib.SMTPAuthenticationError(retcode, capabilities)
+    return outgoing_mail_server
+
+
+class MeteredSMTP(smtplib.SMTP):
+    """An SMTP client that records the latency of its commands and the bytes transferred in the given Metrics, like
+    SpoolingIMAP4_SSL does for IMAP."""
+
+    def __init__(self, host, port, metrics):
+        self.metrics = metrics
+        super().__init__(host, port)
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        with self.metrics.timed('smtp_command', 'connect'):
+            return super().connect(host, port, source_address)
+
+    def starttls(self, *args, **kwargs):
+        with self.metrics.timed('smtp_command', 'starttls'):
+            return super().starttls(*args, **kwargs)
+
+    def login(self, user, password, **kwargs):
+        with self.metrics.timed('smtp_command', 'login'):
+            return super().login(user, password, **kwargs)
+
+    def sendmail(self, *args, **kwargs):
+        with self.metrics.timed('smtp_command', 'sendmail'):
+            return super().sendmail(*args, **kwargs)
+
+    def quit(self):
+        with self.metrics.timed('smtp_command', 'quit'):
+            return super().quit()
+
+    def send(self, s):
+        self.metrics.count('smtp_bytes_sent', len(s))
+        super().send(s)
+
+    def getreply(self):
+        # smtplib reads the replies line by line from this file, which is replaced after STARTTLS
+        if self.file is None and self.sock is not None:
+            self.file = MeteredReader(self.sock.makefile('rb'), self.metrics, 'smtp_bytes_received')
+        return super().getreply()
+
+
+class MeteredReader:
+    """Counts the bytes of the lines read from a file in the given counter of the Metrics."""
+
+    def __init__(self, file, metrics, counter):
+        self.file = file
+        self.metrics = metrics
+        self.counter = counter
+
+    def readline(self, size=-1):
+        line = self.file.readline(size)
+        self.metrics.count(self.counter, len(line))
+        return line
+
+    def close(self):
+        self.file.close()
+
+
+def start_delivery_workers(account):
+    """Start one thread per SMTP connection that sends the replies queued by process_inbox()."""
+    # limit the number of rendered replies waiting for a free connection
+    account.delivery_queue = queue.Queue(maxsize=2 * len(account.outgoing_mail_servers))
+    for index in range(len(account.outgoing_mail_servers)):
+        worker = threading.Thread(target=deliver_replies, args=(account, index), daemon=True)
+        worker.start()
+        account.delivery_workers.append(worker)
+
+
+def deliver_replies(account, index):
+    while True:
+        job = account.delivery_queue.get()
+        if job is None:
+            account.delivery_queue.task_done()
+            return
+        (mail, receiver_email, message) = job
+        with account.metrics.timed('phase', 'send'):
+            failure = send_reply(account, index, receiver_email, message)
+        account.delivery_results.put((mail, receiver_email, failure))
+        account.delivery_queue.task_done()
+
+
+def send_reply(account, index, receiver_email, message):
+    """Send a reply through the given SMTP connection, running the steps of deliver_reply()."""
+    steps = deliver_reply(account, receiver_email, message, account.outgoing_mail_servers[index] is not None)
+    error = None
+    while True:
+        try:
+            step = steps.send(error)
+        except StopIteration as result:
+            return result.value
+        error = None
+        try:
+            if step == 'connect':
+                account.outgoing_mail_servers[index] = do_connect_to_smtp(account)
+            elif step == 'send':
+                account.outgoing_mail_servers[index].sendmail(account.config['display.mail'], receiver_email, message)
+            elif step == 'disconnect':
+                disconnect_from_smtp(account, index)
             else:
-                statistics['mails_loading_error'] += 1
-                log_warning("Failed to get email with index '" + message_index + "'.")
-        statistics['mails_total'] = len(messages)
-        return messages
+                time.sleep(step)
+        except Exception as e:
+            error = e
+
+
+def deliver_reply(account, receiver_email, message, connected):
+    """Send a reply for both engines, reconnecting and retrying on temporary failures.
+
+    Yields the steps 'connect', 'send' and 'disconnect' for the engine to run with its SMTP connection, which sends
+    back the error of the step or None, and the seconds to wait before the next attempt. Returns None if the reply
+    has been delivered, otherwise a tuple of the error and whether retrying is pointless.
+    """
+    delay = SMTP_RETRY_DELAY
+    for attempt in range(account.config['out.retries'] + 1):
+        if attempt > 0:
+            yield delay
+            delay *= 2
+        if not connected:
+            error = yield 'connect'
+            if error is not None:
+                log_debug(account, "Reconnecting to SMTP server failed: '%s'", error)
+                continue
+            connected = True
+        error = yield 'send'
+        if error is None:
+            return None
+        if is_permanent_smtp_error(error):
+            return (error, True)
+        if isinstance(error, (smtplib.SMTPServerDisconnected, OSError)):
+            # the connection is unusable, open a new one for the next attempt
+            yield 'disconnect'
+            connected = False
+        log_debug(account, "Sending reply to %s failed temporarily: '%s'", receiver_email, error)
+    return (error, False)
+
+
+def is_permanent_smtp_error(error):
+    """Tell whether sending a reply failed for good or is worth retrying, like 4xx responses and lost connections."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return not all(400 <= code < 500 for (code, response) in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return not 400 <= error.smtp_code < 500
+    return not isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+
+def is_invalid_recipient_error(error):
+    """Tell whether the server refused the recipient of a reply for good, other errors are not about the email."""
+    return isinstance(error, smtplib.SMTPRecipientsRefused) and \
+        all(500 <= code < 600 for (code, response) in error.recipients.values())
+
+
+def handle_delivered_replies(account):
+    while True:
+        try:
+            (mail, receiver_email, failure) = account.delivery_results.get_nowait()
+        except queue.Empty:
+            return
+        handle_delivery_result(account, mail, receiver_email, failure)
+
+
+def handle_delivery_result(account, mail, receiver_email, failure):
+    """Move an email to trash once its reply has been delivered or its recipient has been refused for good."""
+    if failure is None:
+        log_debug(account, "Reply to %s sent successfully", receiver_email)
+        remember_reply(account, receiver_email, persist=True)
+        delete_email(account, mail)
+    elif failure[1] and is_invalid_recipient_error(failure[0]):
+        # If we can't send the reply due to invalid email address, just log it
+        log_warning(account, "Could not send reply due to invalid recipient address: " + str(failure[0]))
+        delete_email(account, mail)
     else:
+        # keep the email in the inbox, so the reply is sent on the next run, also when the sender address or the
+        # content of the reply has been refused, which needs fixing the configuration rather than dropping the email
+        account.inbox_state['unfinished_uids'].add(int(mail.uid))
+        account.statistics['mails_send_error'] += 1
+        forget_reply(account, receiver_email)
+        unjournal_email(account, mail)
+        log_warning(account, "Could not send reply to " + receiver_email + ", will retry on next run: " +
+                    str(failure[0]))
+
+
+def get_stopped_failure():
+    """The failure of a reply whose sending has not started when the run stops, the next run sends it."""
+    return (RuntimeError("the run was stopped before the reply was sent"), False)
+
+
+def wait_for_deliveries(account):
+    account.delivery_queue.join()
+    handle_delivered_replies(account)
+
+
+def load_send_rate(account):
+    """Set up a token bucket per send rate limit, with the tokens left over from the last run."""
+    now = time.time()
+    for (limit, period) in ((account.config['out.rate.minute'], 60), (account.config['out.rate.hour'], 3600)):
+        if not limit:
+            continue
+        bucket = {'limit': limit, 'period': period, 'tokens': float(limit), 'updated_at': now}
+        if account.state_database is not None:
+            row = account.state_database.execute("SELECT tokens, updated_at FROM send_rate WHERE sender = ? AND "
+                                                 "period = ?", (get_sender_key(account), period)).fetchone()
+            if row is not None:
+                (bucket['tokens'], bucket['updated_at']) = row
+        account.send_rate.append(bucket)
+
+
+def save_send_rate(account):
+    if account.state_database is None or not account.send_rate:
+        return
+    with account.state_database:
+        for bucket in account.send_rate:
+            account.state_database.execute(
+                "INSERT OR REPLACE INTO send_rate (sender, period, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                (get_sender_key(account), bucket['period'], bucket['tokens'], bucket['updated_at']))
+
+
+def get_sender_key(account):
+    # the limits apply to the SMTP login, which may be shared by several inboxes
+    return account.config['out.user'] + "@" + account.config['out.host'] + ":" + account.config['out.port']
+
+
+def take_send_token(account):
+    """Take a token from every send rate bucket and return the seconds to wait until the reply may be sent.
+
+    Returns None without taking tokens if the wait would be longer than the configured maximum and the reply can be
+    deferred to the outbox instead. Tokens are taken in advance, so later replies wait for their own tokens.
+    """
+    now = time.time()
+    delay = 0
+    for bucket in account.send_rate:
+        rate = bucket['limit'] / bucket['period']
+        bucket['tokens'] = min(bucket['limit'], bucket['tokens'] + (now - bucket['updated_at']) * rate)
+        bucket['updated_at'] = now
+        if bucket['tokens'] < 1:
+            delay = max(delay, (1 - bucket['tokens']) / rate)
+    if delay > account.config['out.rate.max.wait'] and account.state_database is not None:
+        return None
+    for bucket in account.send_rate:
+        bucket['tokens'] -= 1
+    if delay:
+        log_debug(account, "Waiting %.1f seconds for the send rate limit, %d replies in outbox", delay,
+                  account.outbox_size)
+    return delay
+
+
+def schedule_reply(account, mail, receiver_email, message):
+    """Return the seconds to wait before sending a reply, or None if the reply has been deferred to the outbox."""
+    delay = take_send_token(account)
+    if delay is not None:
+        return delay
+    with account.state_database:
+        account.state_database.execute(
+            "INSERT INTO outbox (inbox, recipient, message, queued_at) VALUES (?, ?, ?, ?)",
+            (get_inbox_key(account), receiver_email, message, time.time()))
+        # the reply is as good as sent, the email is handled
+        remember_reply(account, receiver_email, persist=True)
+        delete_email(account, mail)
+    account.outbox_size += 1
+    log_debug(account, "Send rate limit reached, deferring reply to %s, %d replies in outbox", receiver_email,
+              account.outbox_size)
+    return None
+
+
+def send_deferred_replies(account):
+    """Send the replies deferred to the outbox by earlier runs before any new ones, as far as the send rate allows."""
+    # in daemon mode, replies of a pass that lost its IMAP connection may still be on their way
+    wait_for_deliveries(account)
+    for (outbox_id, receiver_email, message) in get_deferred_replies(account):
+        delay = take_send_token(account)
+        if delay is None:
+            break
+        time.sleep(delay)
+        # no other replies are being sent, so the connection of the first delivery worker is free
+        with account.metrics.timed('phase', 'send'):
+            failure = send_reply(account, 0, receiver_email, message)
+        if not handle_deferred_delivery_result(account, outbox_id, receiver_email, failure):
+            break
+    log_outbox_size(account)
+
+
+def get_deferred_replies(account):
+    if account.state_database is None:
         return []
+    replies = account.state_database.execute("SELECT id, recipient, message FROM outbox WHERE inbox = ? ORDER BY id",
+                                             (get_inbox_key(account),)).fetchall()
+    account.outbox_size = len(replies)
+    if replies:
+        log_debug(account, "Sending %d deferred replies from outbox", len(replies))
+    return replies
 
 
-def process_email(mail):
-    try:
-        mail_from = email.header.decode_header(mail['From'])
-        mail_sender = mail_from[-1]
-        mail_sender = cast(mail_sender[0], str, 'UTF-8')
-        log_debug("Processing email from: " + mail_sender)
-        
-        # Check if we should filter by sender or respond to all emails
-        if config['request.from'] == '' or config['request.from'] == '*':
-            # No filtering - respond to all emails
-            log_debug("No sender filter active - responding to email")
-            reply_to_email(mail)
-            delete_email(mail)
-        elif config['request.from'] in mail_sender:
-            # Filter by sender
-            log_debug("Sender matches filter '" + config['request.from'] + "' - responding to email")
-            reply_to_email(mail)
-            delete_email(mail)
+def handle_deferred_delivery_result(account, outbox_id, receiver_email, failure):
+    """Remove a deferred reply from the outbox unless sending it can succeed later, in which case False is returned."""
+    if failure is not None and not (failure[1] and is_invalid_recipient_error(failure[0])):
+        log_warning(account, "Could not send deferred reply to " + receiver_email + ", will retry on next run: " +
+                    str(failure[0]))
+        return False
+    if failure is None:
+        log_debug(account, "Deferred reply to %s sent successfully", receiver_email)
+    else:
+        log_warning(account, "Could not send deferred reply due to invalid recipient address: " + str(failure[0]))
+    with account.state_database:
+        account.state_database.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+    account.outbox_size -= 1
+    return True
+
+
+def log_outbox_size(account):
+    if account.outbox_size:
+        log_debug(account, "%d replies remain in outbox", account.outbox_size)
+
+
+def fetch_emails(account):
+    """Yield the emails of the inbox one by one while downloading them chunk by chunk."""
+    # get the message uids from the inbox folder
+    account.incoming_mail_server.select(account.config['folders.inbox'])
+    yield from run_imap_commands(account.incoming_mail_server,
+                                 download_emails(account, account.incoming_mail_server.response('UIDVALIDITY')[1][0]))
+
+
+def download_emails(account, uidvalidity):
+    """Download the emails of the inbox chunk by chunk and yield them one by one, for both engines.
+
+    The IMAP commands are yielded as well and their responses sent back, see run_imap_commands().
+    """
+    load_inbox_state(account, uidvalidity)
+    with account.metrics.timed('phase', 'search'):
+        (retcode, message_uids) = yield ('uid', 'SEARCH', *get_search_criteria(account))
+    if retcode != 'OK':
+        return
+    for chunk in split_into_chunks(account, get_new_uids(account, message_uids)):
+        # first only get the headers needed to decide whether to reply for the current chunk of uids
+        with account.metrics.timed('phase', 'fetch'):
+            (retcode, data) = yield ('uid', 'FETCH', format_uid_set(chunk), FETCH_HEADER_ITEMS)
+        with account.metrics.timed('phase', 'parse'):
+            messages = parse_email_headers(account, chunk, retcode, data)
+        del data
+        # then get the bodies, but only for emails that will be replied to with their body
+        raw_messages = {}
+        download_uids = get_uids_to_download(account, messages)
+        if download_uids:
+            with account.metrics.timed('phase', 'fetch'):
+                (retcode, data) = yield ('uid', 'FETCH', format_uid_set(download_uids), get_body_items(account))
+            if retcode == 'OK':
+                with account.metrics.timed('phase', 'parse'):
+                    raw_messages = parse_fetch_response(data)
+            del data
+        yield from complete_emails(account, chunk, messages, download_uids, raw_messages)
+
+
+def run_imap_commands(server, steps):
+    """Run the IMAP commands of a generator like download_emails() with an imaplib connection.
+
+    The generator yields every command as a tuple of the method of the connection and its arguments, like
+    ('uid', 'FETCH', '1:5', '(UID)'), and gets the response back, or the error raised where it yielded the command.
+    Everything else it yields is passed on. This way the threaded and the asyncio engine share the same logic, see
+    run_imap_commands_async().
+    """
+    (response, error) = (None, None)
+    while True:
+        try:
+            step = steps.send(response) if error is None else steps.throw(error)
+        except StopIteration:
+            return
+        (response, error) = (None, None)
+        if not isinstance(step, tuple):
+            yield step
+            continue
+        try:
+            response = getattr(server, step[0])(*step[1:])
+        except Exception as e:
+            error = e
+
+
+def get_search_criteria(account):
+    if account.inbox_state['last_uid']:
+        # only search for emails that arrived since the last run and those that could not be handled by it
+        uid_set = str(account.inbox_state['last_uid'] + 1) + ':*'
+        if account.inbox_state['retry_uids']:
+            uid_set = format_uid_set(account.inbox_state['retry_uids']) + ',' + uid_set
+        return ('UID', uid_set)
+    return ('ALL',)
+
+
+def get_new_uids(account, search_response):
+    # a search for "n:*" always returns the highest uid, even if it is lower than n
+    message_uids = [cast(uid, str, 'UTF-8') for uid in search_response[0].split()
+                    if int(uid) > account.inbox_state['last_uid'] or int(uid) in account.inbox_state['retry_uids']]
+    retried = sum(1 for uid in message_uids if int(uid) in account.inbox_state['retry_uids'])
+    log_debug(account, "Found %d new emails in inbox", len(message_uids) - retried)
+    if retried:
+        log_debug(account, "Examining %d emails again that could not be handled before", retried)
+    return message_uids
+
+
+def split_into_chunks(account, message_uids):
+    chunk_size = account.config['fetch.chunk.size']
+    return [message_uids[offset:offset + chunk_size] for offset in range(0, len(message_uids), chunk_size)]
+
+
+def parse_email_headers(account, chunk, retcode, data):
+    """Parse the response of the header FETCH for a chunk of uids into messages containing only the headers."""
+    account.inbox_state['examined_uid'] = int(chunk[-1])
+    if retcode != 'OK':
+        account.statistics['mails_loading_error'] += len(chunk)
+        account.inbox_state['unfinished_uids'].update(int(mail_uid) for mail_uid in chunk)
+        log_warning(account, "Failed to get emails with UIDs '" + format_uid_set(chunk) + "'.")
+        return {}
+    messages = {}
+    sizes = {}
+    for (mail_uid, raw_header) in parse_fetch_response(data, sizes).items():
+        messages[mail_uid] = FetchedEmail(mail_uid, read_literal(raw_header), sizes.get(mail_uid))
+    return messages
+
+
+def get_uids_to_download(account, messages):
+    """Select the emails whose body needs to be downloaded because the reply contains it."""
+    if not account.config['reply.needs.body']:
+        return []
+    download_uids = []
+    for (mail_uid, message) in messages.items():
+        try:
+            examine_email(account, message)
+            if message.journal_state is not None or not message.sender_match[0]:
+                continue
+            if message.suppression_reason is not None or get_recent_reply_reason(account, message) is not None:
+                continue
+        except Exception:
+            # download the email anyway, processing it reports the error without stopping the other emails
+            download_uids.append(mail_uid)
+            continue
+        max_size = account.config['fetch.max.size']
+        if max_size and message.size is not None and message.size > max_size:
+            log_debug(account, "Not downloading the body of email with UID '%s', its size of %d bytes exceeds the "
+                      "maximum size", mail_uid, message.size)
+            continue
+        download_uids.append(mail_uid)
+    return download_uids
+
+
+def get_body_items(account):
+    """The FETCH items to download the body of emails, limited to its first bytes if configured."""
+    if account.config['fetch.body.size']:
+        return '(UID BODY.PEEK[TEXT]<0.' + str(account.config['fetch.body.size']) + '>)'
+    return '(UID BODY.PEEK[TEXT])'
+
+
+def complete_emails(account, chunk, messages, download_uids, raw_messages):
+    """Yield the emails of a chunk in order, adding the complete message to those that have been downloaded."""
+    for mail_uid in download_uids:
+        if mail_uid not in raw_messages:
+            del messages[mail_uid]
+    last_uid = next((mail_uid for mail_uid in reversed(chunk) if mail_uid in messages), None)
+    for mail_uid in chunk:
+        # release the data of every message as soon as it has been handed out
+        message = messages.pop(mail_uid, None)
+        if message is None:
+            account.statistics['mails_loading_error'] += 1
+            account.inbox_state['unfinished_uids'].add(int(mail_uid))
+            log_warning(account, "Failed to get email with UID '" + mail_uid + "'.")
+            continue
+        message.raw_body = raw_messages.pop(mail_uid, None)
+        message.last_of_chunk = mail_uid == last_uid
+        account.statistics['mails_total'] += 1
+        yield message
+
+
+class FetchedEmail:
+    """An email of the inbox, parsed from the downloaded bytes only when its headers or its body are first used."""
+
+    def __init__(self, uid, raw_header, size=None):
+        self.uid = uid
+        self.size = size
+        self.raw_header = raw_header
+        # the downloaded body, as bytes or as a file if it was too large, possibly cut off after the configured size
+        self.raw_body = None
+        # the decisions of examine_email(), made before downloading the body and used again when processing the email
+        self.journal_state = None
+        self.sender = None
+        self.sender_match = None
+        self.suppression_reason = None
+        # the replies to the emails of a chunk are journaled together and sent after its last email
+        self.last_of_chunk = False
+        self._headers = None
+        self._values = {}
+        self._message = None
+
+    @property
+    def headers(self):
+        """The headers fetched to decide whether to reply, without parsing the rest of the email.
+
+        Unlike the modern email policy, compat32 leaves the header values as they are, so parsing them is cheap.
+        """
+        if self._headers is None:
+            self._headers = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(self.raw_header)
+        return self._headers
+
+    @property
+    def message(self):
+        """The email with its MIME tree, or only the headers if its body has not been downloaded."""
+        if self._message is None:
+            # the fetched headers include those describing the body, the headers of nested parts are in the body
+            parser = email.parser.BytesFeedParser(policy=email.policy.compat32)
+            parser.feed(self.raw_header)
+            if isinstance(self.raw_body, bytes):
+                parser.feed(self.raw_body)
+            elif self.raw_body is not None:
+                with self.raw_body:
+                    self.raw_body.seek(0)
+                    for block in iter(lambda: self.raw_body.read(65536), b''):
+                        parser.feed(block)
+            self._message = parser.close()
+            self.raw_body = None
+        return self._message
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def get(self, name, default=None):
+        """Return the value of a fetched header with its encoded words decoded, decoding it only once."""
+        name = name.lower()
+        if name not in self._values:
+            self._values[name] = decode_header_field(self.headers.get(name))
+        value = self._values[name]
+        return default if value is None else value
+
+
+def decode_header_field(value):
+    """Decode a header value of the compat32 policy into text, like the modern email policy does."""
+    if value is None:
+        return None
+    # header values with 8-bit characters are Header objects, their undecodable bytes are replaced
+    return decode_header_value(''.join(str(value).splitlines()))
+
+
+def load_inbox_state(account, uidvalidity):
+    """Read the highest uid examined by earlier runs, which is only valid as long as the UIDVALIDITY is the same."""
+    account.inbox_state['uidvalidity'] = cast(uidvalidity, int)
+    account.inbox_state['last_uid'] = 0
+    account.inbox_state['examined_uid'] = 0
+    account.inbox_state['unfinished_uids'] = set()
+    account.inbox_state['retry_uids'] = {}
+    if account.state_database is None or account.inbox_state['uidvalidity'] is None:
+        return
+    row = account.state_database.execute("SELECT uidvalidity, last_uid FROM inbox_state WHERE inbox = ?",
+                                         (get_inbox_key(account),)).fetchone()
+    if row is None:
+        return
+    if row[0] != account.inbox_state['uidvalidity']:
+        log_debug(account, "UIDVALIDITY of inbox has changed, examining all emails again")
+        return
+    account.inbox_state['last_uid'] = row[1]
+    account.inbox_state['retry_uids'] = dict(account.state_database.execute(
+        "SELECT uid, attempts FROM retries WHERE inbox = ? AND uidvalidity = ?",
+        (get_inbox_key(account), account.inbox_state['uidvalidity'])).fetchall())
+
+
+def save_inbox_state(account):
+    """Remember the highest examined uid, so the next run can skip the emails up to it, and the emails below it
+    that could not be handled, so the next runs examine them again until they have failed too often."""
+    if account.state_database is None or account.inbox_state['uidvalidity'] is None:
+        return
+    last_uid = max(account.inbox_state['last_uid'], account.inbox_state['examined_uid'])
+    retry_uids = {}
+    for mail_uid in sorted(account.inbox_state['unfinished_uids']):
+        attempts = account.inbox_state['retry_uids'].get(mail_uid, 0) + 1
+        if attempts > account.config['email.retries']:
+            log_warning(account, "Giving up on email with UID '" + str(mail_uid) + "' after " + str(attempts) +
+                        " failed attempts, it stays in the inbox.")
         else:
-            log_debug("Sender does not match filter '" + config['request.from'] + "' - skipping email")
-            statistics['mails_wrong_sender'] += 1
-        statistics['mails_processed'] += 1
-    except Exception as e:
-        log_warning("Unexpected error while processing email: '" + str(e) + "'.")
+            retry_uids[mail_uid] = attempts
+    with account.state_database:
+        account.state_database.execute(
+            "INSERT OR REPLACE INTO inbox_state (inbox, uidvalidity, last_uid) VALUES (?, ?, ?)",
+            (get_inbox_key(account), account.inbox_state['uidvalidity'], last_uid))
+        account.state_database.execute("DELETE FROM retries WHERE inbox = ?", (get_inbox_key(account),))
+        account.state_database.executemany(
+            "INSERT INTO retries (inbox, uidvalidity, uid, attempts) VALUES (?, ?, ?, ?)",
+            [(get_inbox_key(account), account.inbox_state['uidvalidity'], mail_uid, attempts)
+             for (mail_uid, attempts) in retry_uids.items()])
+    account.inbox_state['last_uid'] = last_uid
+    account.inbox_state['retry_uids'] = retry_uids
+
+
+def get_inbox_key(account):
+    # identifies the inbox, so several accounts can share a state file
+    return (account.config['in.user'] + "@" + account.config['in.host'] + ":" + account.config['in.port'] + "/" +
+            account.config['folders.inbox'])
+
+
+def parse_fetch_response(data, sizes=None):
+    """Map the UIDs of a multi-message FETCH response to the literal message data returned for them.
+
+    If a dict is given for sizes, it is filled with the RFC822.SIZE returned for the UIDs.
+    """
+    raw_messages = {}
+    mail_uid = None
+    literal = None
+    size = None
+    for item in data:
+        if isinstance(item, tuple):
+            # a new message starts with "<index> (" and carries its data as literal
+            if re.match(rb'\d+ \(', item[0]):
+                mail_uid = None
+                size = None
+            literal = item[1]
+            response = item[0]
+        else:
+            response = item
+        match = re.search(rb'UID (\d+)', response)
+        if match:
+            mail_uid = cast(match.group(1), str, 'UTF-8')
+        match = re.search(rb'RFC822\.SIZE (\d+)', response)
+        if match:
+            size = int(match.group(1))
+        if mail_uid is not None and literal is not None:
+            raw_messages[mail_uid] = literal
+            literal = None
+        if mail_uid is not None and size is not None and sizes is not None:
+            sizes[mail_uid] = size
+            size = None
+    return raw_messages
+
+
+def read_literal(literal):
+    """Return the content of a literal, which is a temporary file if it was larger than FETCH_SPOOL_SIZE."""
+    if isinstance(literal, bytes):
+        return literal
+    with literal:
+        literal.seek(0)
+        return literal.read()
+
+
+class SpoolingIMAP4_SSL(imaplib.IMAP4_SSL):
+    """An IMAP4_SSL client that downloads large literals into a temporary file instead of holding them in memory.
+
+    It also records the latency of every command and the number of bytes transferred in the given Metrics.
+    """
+
+    def __init__(self, host, port, metrics):
+        self.metrics = metrics
+        super().__init__(host, port)
+
+    def _simple_command(self, name, *args):
+        # UID commands are told apart by the command they run, like 'UID FETCH'
+        command = name + ' ' + args[0] if name == 'UID' else name
+        with self.metrics.timed('imap_command', command):
+            return super()._simple_command(name, *args)
+
+    def send(self, data):
+        self.metrics.count('imap_bytes_sent', len(data))
+        super().send(data)
+
+    def readline(self):
+        line = super().readline()
+        self.metrics.count('imap_bytes_received', len(line))
+        return line
+
+    def read(self, size):
+        self.metrics.count('imap_bytes_received', size)
+        if size <= FETCH_SPOOL_SIZE:
+            return super().read(size)
+        literal = tempfile.TemporaryFile()
+        while size > 0:
+            block = super().read(min(size, 65536))
+            if not block:
+                literal.close()
+                raise self.abort("socket error: EOF")
+            literal.write(block)
+            size -= len(block)
+        return literal
 
 
-def reply_to_email(mail):
+def format_uid_set(uids):
+    """Format a list of UIDs as a compact IMAP sequence set like '3,7:12'."""
+    ranges = []
+    for uid in sorted(int(uid) for uid in uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else str(start) + ':' + str(end) for (start, end) in ranges)
+
+
+def process_emails(account):
+    """Decide about the emails of the inbox and schedule their replies for both engines.
+
+    Yields 'next' for the engine to send back the next email, or None once there are no more, the seconds to wait for
+    the send rate limit, ('send', mail, receiver_email, message) for the engine to hand a reply to a free SMTP
+    connection, waiting while too many rendered replies are waiting for one, and 'move' once enough emails are queued
+    for moving to trash. An email is moved to trash once its reply has been sent.
+    """
+    batch = []
+    try:
+        while True:
+            mail = yield 'next'
+            if mail is None:
+                break
+            reply = process_email(account, mail)
+            delay = None if reply is None else schedule_reply(account, mail, *reply)
+            if delay is not None:
+                if delay:
+                    yield from send_replies(account, batch)
+                    yield delay
+                # until the reply has been sent, other emails from the same sender in this run don't get one either
+                remember_reply(account, reply[0])
+                journal_email(account, mail, 'sending')
+                batch.append((mail,) + reply)
+            if mail.last_of_chunk:
+                yield from send_replies(account, batch)
+            if len(account.trash_queue) >= account.config['fetch.chunk.size']:
+                yield 'move'
+        yield from send_replies(account, batch)
+    finally:
+        # the engine closes the steps when the run stops, the replies it has not taken yet are sent by the next run
+        for (mail, receiver_email, message) in batch:
+            handle_delivery_result(account, mail, receiver_email, get_stopped_failure())
+
+
+def send_replies(account, batch):
+    """Commit the journal entries of a batch of replies before yielding them to be sent, see process_emails().
+
+    Should the run stop while they are being sent, the next run doesn't reply to their emails again.
+    """
+    if not batch:
+        return
+    if account.state_database is not None:
+        account.state_database.commit()
+    while batch:
+        yield ('send',) + batch[0]
+        del batch[0]
+
+
+def process_email(account, mail):
+    """Decide about an email for both engines and return the reply to send as (receiver_email, message), or None.
+
+    Emails that don't get a reply are queued for moving to trash right away.
+    """
     try:
-        # Try to get Reply-To header, fallback to From if not present
-        if mail.get('Reply-To'):
-            # Decode Reply-To header
-            reply_to_header = email.header.decode_header(mail['Reply-To'])
-            if reply_to_header and reply_to_header[0]:
-                receiver_email = str(reply_to_header[0][0])
-                # Clean up the email address
-                receiver_email = receiver_email.strip()
-                # Remove any angle brackets if present
-                if '<' in receiver_email and '>' in receiver_email:
-                    email_match = re.search(r'<(.+?)>', receiver_email)
-                    if email_match:
-                        receiver_email = email_match.group(1)
+        reply = None
+        examine_email(account, mail)
+        if is_replied_before(account, mail):
+            delete_email(account, mail)
+        elif should_reply_to_email(account, mail):
+            if is_reply_suppressed(account, mail):
+                delete_email(account, mail)
             else:
-                raise ValueError("Empty Reply-To header")
+                reply = prepare_reply(account, mail)
+        account.statistics['mails_processed'] += 1
+        return reply
+    except Exception as e:
+        account.inbox_state['unfinished_uids'].add(int(mail.uid))
+        log_warning(account, "Unexpected error while processing email: '" + str(e) + "'.")
+        return None
+
+
+def examine_email(account, mail):
+    """Make the decisions about an email that only depend on its headers and on earlier runs, once per email."""
+    if mail.sender_match is not None:
+        return
+    mail.journal_state = get_journal_state(account, mail)
+    mail.sender = get_email_sender(mail)
+    mail.sender_match = match_sender(account, mail.sender)
+    mail.suppression_reason = get_automatic_email_reason(mail)
+
+
+def should_reply_to_email(account, mail):
+    log_debug(account, "Processing email from: %s", mail.sender)
+    (allowed, reason) = mail.sender_match
+    log_debug(account, reason)
+    if not allowed:
+        account.statistics['mails_wrong_sender'] += 1
+    return allowed
+
+
+def get_email_sender(mail):
+    mail_from = email.header.decode_header(mail['From'])
+    mail_sender = mail_from[-1]
+    return cast(mail_sender[0], str, 'UTF-8')
+
+
+def match_sender(account, mail_sender):
+    """Decide whether to reply to a sender and return the decision with the reason for it."""
+    # Check if we should filter by sender or respond to all emails
+    (allowed_senders, denied_senders) = account.config['request.filter']
+    if not allowed_senders and not denied_senders:
+        # No filtering - respond to all emails
+        return (True, "No sender filter active - responding to email")
+    rule = denied_senders.match(mail_sender)
+    if rule is not None:
+        return (False, "Sender matches denied " + rule + " - skipping email")
+    if not allowed_senders:
+        return (True, "Sender matches no denied sender - responding to email")
+    rule = allowed_senders.match(mail_sender)
+    if rule is not None:
+        # Filter by sender
+        return (True, "Sender matches filter " + rule + " - responding to email")
+    return (False, "Sender does not match filter - skipping email")
+
+
+class SenderRules:
+    """A set of rules for sender addresses, compiled so that matching a sender takes about the same time for any
+    number of rules: exact addresses are kept in a set, domains in an index of their labels from right to left,
+    and regular expressions are combined into a single one."""
+
+    def __init__(self):
+        self.addresses = set()
+        self.domains = {}
+        self.patterns = []
+        self.pattern = None
+
+    def __bool__(self):
+        return bool(self.addresses or self.domains or self.patterns)
+
+    def __repr__(self):
+        return ("SenderRules(" + str(len(self.addresses)) + " addresses, " + str(len(self.domains)) +
+                " top level domains, " + str(len(self.patterns)) + " patterns)")
+
+    def add(self, rule):
+        """Add an address, a domain including its subdomains like 'example.com' or '@example.com', a regular
+        expression like '/^info@/' or '*' for all senders."""
+        if rule == '*':
+            self.patterns.append('')
+        elif len(rule) > 2 and rule.startswith('/') and rule.endswith('/'):
+            pattern = rule[1:-1]
+            re.compile(pattern)
+            # in the combined expression, global flags would not be at its start anymore and group numbers would
+            # count the groups of the expressions before
+            if re.search(r'(?<!\\)(?:\\\\)*\\[1-9]', pattern):
+                raise re.error("numbered backreferences are not supported, use named groups like (?P<name>...)")
+            try:
+                re.compile('|(?:' + pattern + ')')
+            except re.error:
+                raise re.error("global flags are not supported, use flags for a group like '(?s:...)'")
+            self.patterns.append(pattern)
+        elif rule.startswith('/'):
+            raise re.error("missing '/' at the end")
+        elif '@' in rule[1:]:
+            self.addresses.add(rule.lower())
         else:
-            # Extract email from From header
-            from_header = email.header.decode_header(mail['From'])
-            from_str = ''
-            for part, encoding in from_header:
-                if isinstance(part, bytes):
-                    from_str += part.decode(encoding or 'utf-8', errors='ignore')
-                else:
-                    from_str += str(part)
-            
-            # Extract email address from string like "Name <email@example.com>"
-            email_match = re.search(r'<(.+?)>', from_str)
-            if email_match:
-                receiver_email = email_match.group(1)
+            node = self.domains
+            for label in reversed(rule.lstrip('@*.').lower().split('.')):
+                node = node.setdefault(label, {})
+            # the end of a domain is marked by the key None, labels are never None, and the end of a domain
+            # matching only its subdomains by the key '*'
+            node['*' if rule.startswith('*.') else None] = rule
+
+    def add_substring(self, text):
+        """Add a text matching senders that contain it, like the single filter of old versions did."""
+        self.patterns.append(re.escape(text))
+
+    def compile(self):
+        if self.patterns:
+            self.pattern = re.compile('|'.join('(?:' + pattern + ')' for pattern in self.patterns), re.IGNORECASE)
+
+    def match(self, mail_sender):
+        """Return a description of the rule a sender matches, or None.
+
+        Regular expressions are searched in the sender like 'Name <name@example.com>', the other rules are matched
+        against the address only.
+        """
+        address = email.utils.parseaddr(mail_sender)[1].lower()
+        if address in self.addresses:
+            return "address '" + address + "'"
+        node = self.domains
+        labels = address.rpartition('@')[2].split('.')
+        while labels:
+            node = node.get(labels.pop())
+            if node is None:
+                break
+            if None in node:
+                return "domain '" + node[None] + "'"
+            if labels and '*' in node:
+                return "domain '" + node['*'] + "'"
+        if self.pattern is not None and self.pattern.search(mail_sender):
+            return "pattern"
+        return None
+
+
+def is_replied_before(account, mail):
+    if mail.journal_state is None:
+        return False
+    log_debug(account, "Email with UID '%s' has already been replied to (%s), only moving it to trash", mail.uid,
+              mail.journal_state)
+    account.statistics['mails_replied_before'] += 1
+    return True
+
+
+def get_journal_state(account, mail):
+    """Look up whether an earlier run has handled the reply to an email and possibly moved it to trash already.
+
+    Emails are identified by their uid and by their Message-ID, which is kept if the UIDVALIDITY of the inbox changes.
+    Returns 'sending', 'replied', 'moved' or None. A reply that was being sent when a run stopped may have been
+    delivered, so it counts as sent rather than risking a second one.
+    """
+    if account.state_database is None or account.inbox_state['uidvalidity'] is None:
+        return None
+    row = account.state_database.execute(
+        "SELECT state FROM journal WHERE inbox = ? AND ((uidvalidity = ? AND uid = ?) OR message_id = ?) "
+        "ORDER BY state = 'moved' DESC LIMIT 1",
+        (get_inbox_key(account), account.inbox_state['uidvalidity'], int(mail.uid), get_message_id(mail))).fetchone()
+    return None if row is None else row[0]
+
+
+def journal_email(account, mail, state='replied'):
+    """Record that the reply to an email is being sent, or has been sent or is not needed, so only moving it to trash
+    is left. Committed with the next batch of replies, the next move or the inbox state."""
+    if account.state_database is None or account.inbox_state['uidvalidity'] is None:
+        return
+    account.state_database.execute(
+        "INSERT OR REPLACE INTO journal (inbox, uidvalidity, uid, message_id, state, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (get_inbox_key(account), account.inbox_state['uidvalidity'], int(mail.uid), get_message_id(mail), state,
+         time.time()))
+
+
+def unjournal_email(account, mail):
+    """Forget that the reply to an email was being sent, because it has not been delivered."""
+    if account.state_database is None or account.inbox_state['uidvalidity'] is None:
+        return
+    account.state_database.execute(
+        "DELETE FROM journal WHERE inbox = ? AND uidvalidity = ? AND uid = ? AND state = 'sending'",
+        (get_inbox_key(account), account.inbox_state['uidvalidity'], int(mail.uid)))
+
+
+def journal_moved_emails(account, mail_uids):
+    if account.state_database is None or account.inbox_state['uidvalidity'] is None:
+        return
+    now = time.time()
+    with account.state_database:
+        account.state_database.executemany(
+            "UPDATE journal SET state = 'moved', updated_at = ? WHERE inbox = ? AND uidvalidity = ? AND uid = ?",
+            [(now, get_inbox_key(account), account.inbox_state['uidvalidity'], int(mail_uid))
+             for mail_uid in mail_uids])
+
+
+def get_message_id(mail):
+    return decode_header_value(mail.get('Message-ID', '')).strip() or None
+
+
+def is_reply_suppressed(account, mail):
+    reason = mail.suppression_reason or get_recent_reply_reason(account, mail)
+    if reason is None:
+        return False
+    log_debug(account, "Not replying to email: %s", reason)
+    account.statistics['mails_suppressed'] += 1
+    return True
+
+
+def get_automatic_email_reason(mail):
+    """Check whether an email must not get a reply, because it was sent automatically (RFC 3834) or by a mailing
+    list. Return the reason or None."""
+    auto_submitted = str(mail.get('Auto-Submitted', 'no')).split(';')[0].strip().lower()
+    if auto_submitted != 'no':
+        return "it was sent automatically (Auto-Submitted: " + auto_submitted + ")"
+    precedence = str(mail.get('Precedence', '')).strip().lower()
+    if precedence in ('bulk', 'list', 'junk', 'auto_reply'):
+        return "it was sent in bulk (Precedence: " + precedence + ")"
+    if mail.get('List-Id') is not None:
+        return "it was sent by a mailing list"
+    # sent by Microsoft Exchange to ask for no automatic replies
+    suppress = str(mail.get('X-Auto-Response-Suppress', '')).lower()
+    if 'all' in suppress or 'autoreply' in suppress or 'oof' in suppress:
+        return "the sender asked for no automatic replies"
+    return None
+
+
+def get_recent_reply_reason(account, mail):
+    """Check whether the sender of an email got a reply recently, which changes while the emails are processed.
+    Return the reason or None."""
+    if not account.config['reply.suppression.ttl']:
+        return None
+    try:
+        receiver_email = get_reply_receiver(mail)
+    except ValueError:
+        return None
+    replied_at = get_last_reply_time(account, receiver_email)
+    if replied_at is not None and replied_at > time.time() - account.config['reply.suppression.ttl']:
+        return receiver_email + " got a reply recently"
+    return None
+
+
+def get_last_reply_time(account, receiver_email):
+    """Look up when a recipient got the last reply, in memory first and then in the state file."""
+    recipient = receiver_email.lower()
+    if recipient in account.reply_cache:
+        account.reply_cache.move_to_end(recipient)
+        return account.reply_cache[recipient]
+    replied_at = None
+    if account.state_database is not None:
+        row = account.state_database.execute("SELECT replied_at FROM replies WHERE inbox = ? AND recipient = ?",
+                                             (get_inbox_key(account), recipient)).fetchone()
+        if row is not None:
+            replied_at = row[0]
+    cache_reply_time(account, recipient, replied_at)
+    return replied_at
+
+
+def remember_reply(account, receiver_email, persist=False):
+    """Remember that a recipient got a reply now, only in memory until the reply has been sent."""
+    if not account.config['reply.suppression.ttl']:
+        return
+    recipient = receiver_email.lower()
+    replied_at = time.time()
+    cache_reply_time(account, recipient, replied_at)
+    if persist and account.state_database is not None:
+        # committed together with the journal
+        account.state_database.execute(
+            "INSERT OR REPLACE INTO replies (inbox, recipient, replied_at) VALUES (?, ?, ?)",
+            (get_inbox_key(account), recipient, replied_at))
+
+
+def forget_reply(account, receiver_email):
+    """Forget a reply that could not be sent, so the email is answered on the next attempt."""
+    account.reply_cache.pop(receiver_email.lower(), None)
+
+
+def cache_reply_time(account, recipient, replied_at):
+    account.reply_cache[recipient] = replied_at
+    account.reply_cache.move_to_end(recipient)
+    if len(account.reply_cache) > REPLY_CACHE_SIZE:
+        account.reply_cache.popitem(last=False)
+
+
+def prepare_reply(account, mail):
+    """Render the reply to an email, or move the email to trash if it has no valid address to reply to."""
+    try:
+        receiver_email = get_reply_receiver(mail)
+    except ValueError as e:
+        log_warning(account, "Could not send reply due to invalid recipient address: " + str(e))
+        # a reply is never possible, other errors leave the email in the inbox for the next run
+        delete_email(account, mail)
+        return None
+    return build_reply(account, mail, receiver_email)
+
+
+def build_reply(account, mail, receiver_email):
+    """Render the reply to an email for the given recipient."""
+    log_debug(account, "Queueing reply to: %s", receiver_email)
+
+    # Replace template variables in subject and body
+    with account.metrics.timed('phase', 'render'):
+        variables = TemplateVariables(account, mail)
+        reply_subject = render_template(account.config['reply.subject.template'], variables)
+        reply_body = None
+        if account.reply_skeleton['body'] is None:
+            reply_body = render_template(account.config['reply.body.template'], variables)
+        return (receiver_email, render_reply(account, receiver_email, reply_subject, reply_body))
+
+
+def get_reply_receiver(mail):
+    # Try to get Reply-To header, fallback to From if not present
+    if mail.get('Reply-To'):
+        # Decode Reply-To header
+        reply_to_header = email.header.decode_header(mail['Reply-To'])
+        if reply_to_header and reply_to_header[0]:
+            receiver_email = str(reply_to_header[0][0])
+            # Clean up the email address
+            receiver_email = receiver_email.strip()
+            # Remove any angle brackets if present
+            if '<' in receiver_email and '>' in receiver_email:
+                email_match = re.search(r'<(.+?)>', receiver_email)
+                if email_match:
+                    receiver_email = email_match.group(1)
+        else:
+            raise ValueError("Empty Reply-To header")
+    else:
+        # Extract email from From header
+        from_header = email.header.decode_header(mail['From'])
+        from_str = ''
+        for part, encoding in from_header:
+            if isinstance(part, bytes):
+                from_str += part.decode(encoding or 'utf-8', errors='ignore')
             else:
-                # If no angle brackets, assume the whole string is the email
-                receiver_email = from_str.strip()
-        
-        # Validate email format (basic check)
-        if not receiver_email or '@' not in receiver_email:
-            raise ValueError("Invalid email format: " + str(receiver_email))
+                from_str += str(part)
         
-        log_debug("Sending reply to: " + str(receiver_email))
-        
-        # Replace template variables in subject and body
-        reply_subject = replace_template_variables(config['reply.subject'], mail)
-        reply_body = replace_template_variables(config['reply.body'], mail)
-        
-        # Create appropriate message type based on content
-        if config.get('reply.body.is_html', False):
-            # Create HTML email
-            from email.mime.multipart import MIMEMultipart
-            from email.mime.text import MIMEText
-            
-            message = MIMEMultipart('alternative')
-            message['Subject'] = reply_subject
-            message['To'] = receiver_email
-            message['From'] = email.utils.formataddr((
-                cast(email.header.Header(config['display.name'], 'utf-8'), str), config['display.mail']))
-            
-            # Create plain text version (strip HTML tags for basic plain text)
-            plain_text = re.sub('<[^<]+?>', '', reply_body)
-            part1 = MIMEText(plain_text, 'plain', 'utf-8')
-            part2 = MIMEText(reply_body, 'html', 'utf-8')
-            
-            message.attach(part1)
-            message.attach(part2)
+        # Extract email address from string like "Name <email@example.com>"
+        email_match = re.search(r'<(.+?)>', from_str)
+        if email_match:
+            receiver_email = email_match.group(1)
         else:
-            # Create plain text email
-            message = email.mime.text.MIMEText(reply_body, 'plain', 'utf-8')
-            message['Subject'] = reply_subject
-            message['To'] = receiver_email
-            message['From'] = email.utils.formataddr((
-                cast(email.header.Header(config['display.name'], 'utf-8'), str), config['display.mail']))
-        
-        outgoing_mail_server.sendmail(config['display.mail'], receiver_email, message.as_string())
-        log_debug("Reply sent successfully")
-        
-    except Exception as e:
-        # If we can't send the reply due to invalid email address, just log it
-        log_warning("Could not send reply due to invalid recipient address: " + str(e))
-        # Don't re-raise - we still want to delete the email
+            # If no angle brackets, assume the whole string is the email
+            receiver_email = from_str.strip()
+    
+    # Validate email format (basic check)
+    if not receiver_email or '@' not in receiver_email:
+        raise ValueError("Invalid email format: " + str(receiver_email))
+    return receiver_email
 
 
-def delete_email(mail):
-    log_debug("Moving email to trash folder")
-    result = incoming_mail_server.uid('COPY', mail['mailserver_email_uid'], config['folders.trash'])
-    if result[0] == "OK":
-        statistics['mails_in_trash'] += 1
-        log_debug("Email moved to trash successfully")
+def prepare_reply_skeleton(account):
+    """Build the parts of the reply that are the same for every email once, instead of for every reply."""
+    account.reply_skeleton['from'] = SMTP_POLICY.fold('From', email.utils.formataddr((
+        cast(email.header.Header(account.config['display.name'], 'utf-8'), str), account.config['display.mail'])))
+    # Create appropriate message type based on content
+    if account.config['reply.body.is_html']:
+        account.reply_skeleton['boundary'] = "===============" + str(random.randrange(sys.maxsize)) + "=="
+        account.reply_skeleton['headers'] = (
+            'Content-Type: multipart/alternative; boundary="' + account.reply_skeleton['boundary'] + '"\r\n'
+            'MIME-Version: 1.0\r\n')
     else:
-        log_warning("Copying email to trash failed. Reason: " + str(result))
-    incoming_mail_server.uid('STORE', mail['mailserver_email_uid'], '+FLAGS', r'(\Deleted)')
-    incoming_mail_server.expunge()
+        (account.reply_skeleton['headers'], body) = encode_text_part('', 'plain')
+    # tell other autoresponders not to reply to this reply (RFC 3834)
+    account.reply_skeleton['headers'] += 'Auto-Submitted: auto-replied\r\n'
+    # A body without template variables is encoded only once
+    account.reply_skeleton['body'] = None
+    if not get_template_variable_names(account.config['reply.body.template']):
+        account.reply_skeleton['body'] = encode_reply_body(account, account.config['reply.body'])
 
 
-def parse_uid(data):
-    pattern_uid = re.compile(r'\d+ \(UID (?P<uid>\d+)\)')
-    match = pattern_uid.match(data)
-    return match.group('uid')
+def render_reply(account, receiver_email, reply_subject, reply_body=None):
+    """Assemble the reply ready for sending from the skeleton and the parts specific to the email."""
+    headers = (account.reply_skeleton['headers'] + SMTP_POLICY.fold('Subject', reply_subject) +
+               SMTP_POLICY.fold('To', receiver_email) + account.reply_skeleton['from'])
+    body = account.reply_skeleton['body'] if reply_body is None else encode_reply_body(account, reply_body)
+    return headers.encode('ascii') + b'\r\n' + body
 
 
-def get_email_body(mail):
-    """Extract the body text from an email message."""
-    body = ""
-    
-    if mail.is_multipart():
-        # Walk through all parts
-        for part in mail.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get('Content-Disposition', ''))
-            
-            # Skip attachments
-            if 'attachment' in content_disposition:
-                continue
-                
-            # Get text/plain and text/html parts
-            if content_type == 'text/plain':
-                try:
-                    body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    break  # Prefer plain text
-                except:
-                    pass
-            elif content_type == 'text/html' and not body:
-                try:
-                    html_body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    # Simple HTML to text conversion
-                    body = re.sub('<[^<]+?>', '', html_body)
-                except:
-                    pass
+def encode_reply_body(account, reply_body):
+    if not account.config['reply.body.is_html']:
+        return encode_text_part(reply_body, 'plain')[1]
+    # Create plain text version of the HTML body
+    plain_text = html_to_text(reply_body)
+    delimiter = b'--' + account.reply_skeleton['boundary'].encode('ascii')
+    parts = [delimiter + b'\r\n']
+    for (text, subtype) in [(plain_text, 'plain'), (reply_body, 'html')]:
+        (headers, body) = encode_text_part(text, subtype)
+        parts.append(headers.encode('ascii') + b'\r\n' + body + b'\r\n' + delimiter)
+        parts.append(b'\r\n')
+    parts[-1] = b'--\r\n'
+    return b''.join(parts)
+
+
+def encode_text_part(text, subtype):
+    """Encode a text as a MIME part, returning its headers and its transfer-encoded body separately."""
+    part = email.mime.text.MIMEText(text, subtype, 'utf-8').as_bytes(policy=SMTP_POLICY)
+    (headers, body) = part.split(b'\r\n\r\n', 1)
+    return (cast(headers, str, 'ascii') + '\r\n', body)
+
+
+def wait_for_new_emails(account):
+    """Block until the IMAP server reports new emails in the inbox or the configured timeout has passed."""
+    # fetch_emails() selects the inbox, so any EXISTS response besides the one of the SELECT
+    # means that new emails have arrived while the inbox was processed
+    if len(account.incoming_mail_server.untagged_responses.pop('EXISTS', [])) > 1:
+        return
+    if 'IDLE' in account.incoming_mail_server.capabilities:
+        log_debug(account, "Waiting for new emails with IMAP IDLE")
+        idle(account, account.config['daemon.idle.timeout'])
     else:
-        # Not multipart - just get the payload
+        log_debug(account, "Polling for new emails every %d seconds", account.config['daemon.poll.interval'])
+        while 'EXISTS' not in account.incoming_mail_server.untagged_responses:
+            time.sleep(account.config['daemon.poll.interval'])
+            account.incoming_mail_server.noop()
+
+
+def idle(account, timeout):
+    """Run the IMAP IDLE command (RFC 2177) until an EXISTS response arrives or the timeout has passed."""
+    # imaplib does not support IDLE yet, so the command is sent and read directly
+    tag = account.incoming_mail_server._new_tag()
+    account.incoming_mail_server.send(tag + b' IDLE\r\n')
+    response = account.incoming_mail_server.readline()
+    if not response:
+        raise imaplib.IMAP4.abort("Server closed the connection")
+    if not response.startswith(b'+'):
+        raise imaplib.IMAP4.abort("IDLE was rejected: " + cast(response, str, 'UTF-8').strip())
+    previous_timeout = account.incoming_mail_server.sock.gettimeout()
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            # unlike select(), reading with a timeout also sees responses that arrived together with the last one
+            # and are already buffered, like an EXISTS sent right after the continuation of IDLE
+            account.incoming_mail_server.sock.settimeout(max(deadline - time.monotonic(), 0.01))
+            try:
+                response = account.incoming_mail_server.readline()
+            except socket.timeout:
+                # a file object can't be read after a timeout, nothing is lost as no response had begun
+                account.incoming_mail_server.file = account.incoming_mail_server.sock.makefile('rb')
+                break
+            if not response or response.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort("Server closed the connection")
+            if re.match(rb'\* \d+ EXISTS', response):
+                log_debug(account, "New email arrived")
+                break
+    finally:
+        account.incoming_mail_server.sock.settimeout(previous_timeout)
+        account.incoming_mail_server.send(b'DONE\r\n')
+        while not response.startswith(tag):
+            response = account.incoming_mail_server.readline()
+            if not response:
+                raise imaplib.IMAP4.abort("Server closed the connection")
+
+
+def delete_email(account, mail):
+    log_debug(account, "Queueing email for moving to trash folder")
+    journal_email(account, mail)
+    account.trash_queue.append(mail.uid)
+
+
+def move_emails_to_trash(account):
+    """Move all emails queued by delete_email() to the trash folder with as few commands as possible."""
+    if not account.trash_queue:
+        return
+    trash_uids = list(account.trash_queue)
+    account.trash_queue.clear()
+    with account.metrics.timed('phase', 'move'):
+        # moving yields no emails, only commands
+        for unused_mail in run_imap_commands(account.incoming_mail_server, trash_emails(
+                account, account.incoming_mail_server.capabilities, trash_uids)):
+            pass
+
+
+def trash_emails(account, capabilities, trash_uids):
+    """Move emails to the trash folder for both engines, yielding the IMAP commands, see run_imap_commands()."""
+    mail_uids = format_uid_set(trash_uids)
+    log_debug(account, "Moving %d emails to trash folder", len(trash_uids))
+    if 'MOVE' in capabilities:
+        result = yield ('uid', 'MOVE', mail_uids, account.config['folders.trash'])
+        if result[0] == "OK":
+            handle_moved_emails(account, trash_uids)
+            return
+        log_warning(account, "Moving emails to trash failed, falling back to copying them. Reason: " + str(result))
+    result = yield ('uid', 'COPY', mail_uids, account.config['folders.trash'])
+    if result[0] != "OK":
+        handle_unmoved_emails(account, trash_uids, 'COPY', result)
+        return
+    result = yield ('uid', 'STORE', mail_uids, '+FLAGS', r'(\Deleted)')
+    if result[0] != "OK":
+        handle_unmoved_emails(account, trash_uids, 'STORE', result)
+        return
+    if 'UIDPLUS' in capabilities:
+        # only expunge the emails that have been handled, not others marked as deleted by someone else
+        result = yield ('uid', 'EXPUNGE', mail_uids)
+    else:
+        result = yield ('expunge',)
+    if result[0] != "OK":
+        handle_unmoved_emails(account, trash_uids, 'EXPUNGE', result)
+        return
+    handle_moved_emails(account, trash_uids)
+
+
+def handle_moved_emails(account, mail_uids):
+    account.statistics['mails_in_trash'] += len(mail_uids)
+    journal_moved_emails(account, mail_uids)
+    log_debug(account, "Emails moved to trash successfully")
+
+
+def handle_unmoved_emails(account, mail_uids, command, result):
+    """Keep emails that could not be moved to trash in the inbox, the next run only moves them without replying."""
+    account.inbox_state['unfinished_uids'].update(int(mail_uid) for mail_uid in mail_uids)
+    log_warning(account, "Moving emails to trash failed at " + command + ", will retry on next run. Reason: " +
+                str(result))
+
+
+def run_async(account):
+    """Process the inbox like process_inbox(), but with overlapping IMAP and SMTP I/O in an asyncio event loop."""
+    log_debug(account, "Using asyncio engine")
+    asyncio.run(process_inbox_async(account))
+
+
+async def process_inbox_async(account):
+    delete_expired_state(account)
+    # one IMAP connection downloads the emails, a second one moves handled emails to trash at the same time
+    with account.metrics.timed('phase', 'connect'):
+        fetch_server = await connect_to_imap_async(account)
+        trash_server = await connect_to_imap_async(account)
+    smtp_servers = asyncio.Queue()
+    fetcher = None
+    tasks = set()
+    try:
+        log_debug(account, "Connecting to SMTP server %s:%s with %d connections", account.config['out.host'],
+                  account.config['out.port'], account.config['out.connections'])
+        with account.metrics.timed('phase', 'connect'):
+            for outgoing_mail_server in await asyncio.gather(
+                    *[connect_to_smtp_async(account) for index in range(account.config['out.connections'])]):
+                smtp_servers.put_nowait(outgoing_mail_server)
+        log_debug(account, "Successfully connected to SMTP server")
+        await send_deferred_replies_async(account, smtp_servers)
+        (retcode, msg_count) = await fetch_server.select(account.config['folders.inbox'])
+        if retcode == "OK":
+            (retcode, msg_count) = await trash_server.select(account.config['folders.trash'])
+        if retcode != "OK":
+            # let the synchronous check list the available folders and exit
+            connect_to_imap(account)
+            check_folder_names(account)
+        await trash_server.select(account.config['folders.inbox'])
+
+        mails = asyncio.Queue(maxsize=account.config['fetch.chunk.size'])
+        fetcher = asyncio.create_task(fetch_emails_async(account, fetch_server, mails))
+        trash_lock = asyncio.Lock()
+        # like the delivery queue of the threaded engine
+        pending_replies = asyncio.Semaphore(2 * account.config['out.connections'])
+        with contextlib.closing(process_emails(account)) as steps:
+            mail = None
+            while True:
+                try:
+                    step = steps.send(mail)
+                except StopIteration:
+                    break
+                mail = None
+                if step == 'next':
+                    mail = await mails.get()
+                elif step == 'move':
+                    task = asyncio.create_task(move_emails_to_trash_async(account, trash_server, trash_lock))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif isinstance(step, tuple):
+                    await pending_replies.acquire()
+                    task = asyncio.create_task(send_reply_async(account, smtp_servers, pending_replies, *step[1:]))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    await asyncio.sleep(step)
+        await fetcher
+        while tasks:
+            # unlike gather(), wait() leaves the replies being sent alone if the run is interrupted meanwhile
+            for task in (await asyncio.wait(list(tasks)))[0]:
+                task.result()
+        await move_emails_to_trash_async(account, trash_server, trash_lock)
+        save_inbox_state(account)
+        save_send_rate(account)
+    except BaseException:
+        # like shutdown() does with the delivery workers after an interrupt or an error like a lost IMAP connection,
+        # replies already being sent are finished and journaled, those still waiting for a connection are left to the
+        # next run
+        account.stop_requested = True
+        if fetcher is not None:
+            fetcher.cancel()
+        if tasks:
+            await asyncio.wait(list(tasks))
+        raise
+    finally:
+        for server in (fetch_server, trash_server):
+            await server.logout()
+        while not smtp_servers.empty():
+            outgoing_mail_server = smtp_servers.get_nowait()
+            if outgoing_mail_server is not None:
+                await outgoing_mail_server.quit()
+
+
+async def fetch_emails_async(account, server, mails):
+    """Put the emails of the inbox into the given queue while downloading them chunk by chunk, like fetch_emails()."""
+    try:
+        await run_imap_commands_async(server, download_emails(account, server.response('UIDVALIDITY')[1][0]), mails)
+    finally:
+        await mails.put(None)
+
+
+async def run_imap_commands_async(server, steps, mails=None):
+    """Run the IMAP commands of a generator like run_imap_commands(), putting the emails it yields into the queue."""
+    (response, error) = (None, None)
+    while True:
         try:
-            body = mail.get_payload(decode=True).decode('utf-8', errors='ignore')
-        except:
-            body = str(mail.get_payload())
-    
-    return body.strip()
+            step = steps.send(response) if error is None else steps.throw(error)
+        except StopIteration:
+            return
+        (response, error) = (None, None)
+        if not isinstance(step, tuple):
+            await mails.put(step)
+            continue
+        try:
+            response = await getattr(server, step[0])(*step[1:])
+        except Exception as e:
+            error = e
 
 
-def replace_template_variables(text, mail):
-    """Replace template variables with actual values from the email."""
-    # Get original subject
-    subject = mail.get('Subject', '')
-    if subject:
-        decoded_subject = email.header.decode_header(subject)
-        subject_str = ''
-        for part, encoding in decoded_subject:
-            if isinstance(part, bytes):
-                subject_str += part.decode(encoding or 'utf-8', errors='ignore')
+async def send_reply_async(account, smtp_servers, pending_replies, mail, receiver_email, message):
+    try:
+        failure = await deliver_reply_async(account, smtp_servers, receiver_email, message)
+        handle_delivery_result(account, mail, receiver_email, failure)
+    finally:
+        pending_replies.release()
+
+
+async def deliver_reply_async(account, smtp_servers, receiver_email, message):
+    """Send a reply with the next free SMTP connection, running the steps of deliver_reply() like send_reply()."""
+    outgoing_mail_server = await smtp_servers.get()
+    if account.stop_requested:
+        smtp_servers.put_nowait(outgoing_mail_server)
+        return get_stopped_failure()
+    start = time.perf_counter()
+    try:
+        steps = deliver_reply(account, receiver_email, message, outgoing_mail_server is not None)
+        error = None
+        while True:
+            try:
+                step = steps.send(error)
+            except StopIteration as result:
+                return result.value
+            error = None
+            try:
+                if step == 'connect':
+                    outgoing_mail_server = await connect_to_smtp_async(account, reconnect=True)
+                elif step == 'send':
+                    await outgoing_mail_server.sendmail(account.config['display.mail'], receiver_email, message)
+                elif step == 'disconnect':
+                    await outgoing_mail_server.quit()
+                    outgoing_mail_server = None
+                else:
+                    await asyncio.sleep(step)
+            except Exception as e:
+                error = e
+    finally:
+        smtp_servers.put_nowait(outgoing_mail_server)
+        # like in the threaded engine, the time waiting for a free connection is not part of sending
+        account.metrics.observe('phase', 'send', time.perf_counter() - start)
+
+
+async def send_deferred_replies_async(account, smtp_servers):
+    """Send the replies deferred to the outbox first, like send_deferred_replies()."""
+    for (outbox_id, receiver_email, message) in get_deferred_replies(account):
+        delay = take_send_token(account)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+        delivery = asyncio.create_task(deliver_reply_async(account, smtp_servers, receiver_email, message))
+        try:
+            failure = await asyncio.shield(delivery)
+        except asyncio.CancelledError:
+            # a reply being sent when the run is interrupted is still removed from the outbox once it has been sent
+            await asyncio.wait([delivery])
+            handle_deferred_delivery_result(account, outbox_id, receiver_email, delivery.result())
+            raise
+        if not handle_deferred_delivery_result(account, outbox_id, receiver_email, failure):
+            break
+    log_outbox_size(account)
+
+
+async def move_emails_to_trash_async(account, server, trash_lock):
+    """Move all emails queued by delete_email() to the trash folder like move_emails_to_trash()."""
+    if not account.trash_queue:
+        return
+    trash_uids = list(account.trash_queue)
+    account.trash_queue.clear()
+    # the commands of several moves must not interleave on the same connection
+    async with trash_lock:
+        with account.metrics.timed('phase', 'move'):
+            await run_imap_commands_async(server, trash_emails(account, server.capabilities, trash_uids))
+
+
+async def connect_to_imap_async(account):
+    try:
+        log_debug(account, "Connecting to IMAP server %s:%s", account.config['in.host'], account.config['in.port'])
+        server = AsyncIMAP4(account.metrics)
+        await server.open(account.config['in.host'], account.config['in.port'])
+        await server.login(account.config['in.user'], account.config['in.pw'])
+        # many servers only advertise extensions like MOVE and UIDPLUS after the login
+        (retcode, capabilities) = await server.capability()
+        if retcode == "OK":
+            server.capabilities = tuple(cast(capabilities[-1], str, 'UTF-8').upper().split())
+        log_debug(account, "Successfully connected to IMAP server")
+        return server
+    except gaierror:
+        shutdown_with_error(account, "IMAP connection failed! Specified host not found.")
+    except imaplib.IMAP4.error as e:
+        shutdown_with_error(account, "IMAP login failed! Reason: '" + cast(e.args[0], str, 'UTF-8') + "'.")
+    except Exception as e:
+        shutdown_with_error(account, "IMAP connection/login failed! Reason: '" + cast(e, str) + "'.")
+
+
+async def connect_to_smtp_async(account, reconnect=False):
+    try:
+        outgoing_mail_server = AsyncSMTP(account.metrics)
+        await outgoing_mail_server.connect(account.config['out.host'], account.config['out.port'])
+        await outgoing_mail_server.starttls()
+        await outgoing_mail_server.login(account.config['out.user'], account.config['out.pw'])
+        return outgoing_mail_server
+    except Exception as e:
+        if reconnect:
+            raise
+        if isinstance(e, gaierror):
+            shutdown_with_error(account, "SMTP connection failed! Specified host not found.")
+        if isinstance(e, smtplib.SMTPAuthenticationError):
+            shutdown_with_error(account, "SMTP login failed! Reason: '" + cast(e.smtp_error, str, 'UTF-8') + "'.")
+        shutdown_with_error(account, "SMTP connection/login failed! Reason: '" + cast(e, str) + "'.")
+
+
+class AsyncIMAP4:
+    """The subset of IMAP4rev1 (RFC 3501) used by this script over asyncio streams.
+
+    Commands return the same (retcode, data) tuples as imaplib, so responses can be parsed by the same functions.
+    Their latency and the bytes transferred are recorded in the given Metrics like by SpoolingIMAP4_SSL.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.reader = None
+        self.writer = None
+        self.tag_number = 0
+        self.capabilities = ()
+        self.untagged_responses = {}
+
+    async def open(self, host, port):
+        # no certificate verification, just like imaplib.IMAP4_SSL by default
+        self.reader, self.writer = await asyncio.open_connection(
+            host, int(port), ssl=ssl._create_stdlib_context(), limit=ASYNC_STREAM_LIMIT)
+        await self.read_response(None)
+
+    async def login(self, user, password):
+        (retcode, data) = await self.command('LOGIN', None, user, quote_imap_string(password))
+        if retcode != 'OK':
+            raise imaplib.IMAP4.error(data[-1])
+        return (retcode, data)
+
+    async def capability(self):
+        return await self.command('CAPABILITY', 'CAPABILITY')
+
+    async def select(self, mailbox):
+        self.untagged_responses = {}
+        return await self.command('SELECT', 'EXISTS', mailbox)
+
+    async def uid(self, command, *args):
+        return await self.command('UID', command if command in ('SEARCH', 'FETCH') else 'FETCH', command, *args)
+
+    async def expunge(self):
+        return await self.command('EXPUNGE', 'EXPUNGE')
+
+    def response(self, code):
+        return (code, self.untagged_responses.pop(code, [None]))
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT', None)
+        except Exception:
+            pass
+        self.writer.close()
+
+    async def command(self, name, response_name, *args):
+        self.tag_number += 1
+        tag = b'A' + str(self.tag_number).encode()
+        line = tag + b' ' + ' '.join((name,) + args).encode('UTF-8') + b'\r\n'
+        self.metrics.count('imap_bytes_sent', len(line))
+        with self.metrics.timed('imap_command', name + ' ' + args[0] if name == 'UID' else name):
+            self.writer.write(line)
+            await self.writer.drain()
+            (retcode, text) = await self.read_response(tag)
+        if retcode != 'OK' or response_name is None:
+            return (retcode, [text])
+        return (retcode, self.untagged_responses.pop(response_name, [None]))
+
+    async def read_response(self, tag):
+        """Read responses until the tagged one (or the greeting), collecting untagged responses like imaplib."""
+        while True:
+            line = await self.read_line()
+            items = [line]
+            # literals like "{123}" at the end of a line are followed by that many bytes and the rest of the line
+            while re.search(rb'\{\d+\}$', items[-1]):
+                size = int(re.search(rb'\{(\d+)\}$', items[-1]).group(1))
+                self.metrics.count('imap_bytes_received', size)
+                if size > FETCH_SPOOL_SIZE:
+                    literal = tempfile.TemporaryFile()
+                    while size > 0:
+                        block = await self.reader.readexactly(min(size, 65536))
+                        literal.write(block)
+                        size -= len(block)
+                else:
+                    literal = await self.reader.readexactly(size)
+                items[-1] = (items[-1], literal)
+                items.append(await self.read_line())
+            if items[-1] == b'':
+                items.pop()
+            first = items[0][0] if isinstance(items[0], tuple) else items[0]
+            if tag is not None and first.startswith(tag + b' '):
+                (retcode, text) = (first[len(tag) + 1:].split(b' ', 1) + [b''])[:2]
+                return (cast(retcode, str, 'ASCII'), text)
+            match = re.match(rb'\* (?:(\d+) )?([A-Za-z-]+) ?(.*)$', first, re.DOTALL)
+            if match is None:
+                continue
+            (number, response_name, data) = match.groups()
+            response_name = cast(response_name, str, 'ASCII').upper()
+            code = re.match(rb'\[([A-Z-]+) ?([^\]]*)\]', data)
+            if code and response_name in ('OK', 'NO', 'BAD', 'PREAUTH'):
+                self.untagged_responses.setdefault(cast(code.group(1), str, 'ASCII'), []).append(code.group(2))
+            if number is not None:
+                data = number + b' ' + data
+            if isinstance(items[0], tuple):
+                items[0] = (data, items[0][1])
             else:
-                subject_str += str(part)
-        subject = subject_str
-    
-    # Get original body
-    body = get_email_body(mail)
-    
-    # Replace variables
-    text = text.replace('[SUBJECT]', subject)
-    text = text.replace('[BODY]', body)
-    
-    # Also support lowercase variants
-    text = text.replace('[subject]', subject)
-    text = text.replace('[body]', body)
-    
-    return text
+                items[0] = data
+            self.untagged_responses.setdefault(response_name, []).extend(items)
+            if tag is None:
+                return (response_name, data)
+
+    async def read_line(self):
+        line = await self.reader.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        self.metrics.count('imap_bytes_received', len(line))
+        return line.rstrip(b'\r\n')
+
+
+def quote_imap_string(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncSMTP:
+    """The subset of SMTP (RFC 5321) with STARTTLS and AUTH used by this script over asyncio streams.
+
+    Errors are raised as the same exceptions smtplib uses, so they can be handled by the same functions. The latency
+    of the commands and the bytes transferred are recorded in the given Metrics like by MeteredSMTP.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.reader = None
+        self.writer = None
+        self.host = None
+        self.features = {}
+
+    async def connect(self, host, port):
+        self.host = host
+        with self.metrics.timed('smtp_command', 'connect'):
+            self.reader, self.writer = await asyncio.open_connection(host, int(port), limit=ASYNC_STREAM_LIMIT)
+            (code, message) = await self.read_reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+        await self.ehlo()
+
+    async def ehlo(self):
+        (code, message) = await self.command('EHLO ' + socket.getfqdn())
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, message)
+        self.features = {}
+        for line in cast(message, str, 'UTF-8').split('\n')[1:]:
+            feature = line.split(' ', 1)
+            self.features[feature[0].upper()] = feature[1] if len(feature) > 1 else ''
+
+    async def starttls(self):
+        if 'STARTTLS' not in self.features:
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        with self.metrics.timed('smtp_command', 'starttls'):
+            (code, message) = await self.command('STARTTLS')
+            if code != 220:
+                raise smtplib.SMTPResponseException(code, message)
+            # no certificate verification, just like smtplib.SMTP.starttls() by default
+            await self.writer.start_tls(ssl._create_stdlib_context(), server_hostname=self.host)
+            await self.ehlo()
+
+    async def login(self, user, password):
+        with self.metrics.timed('smtp_command', 'login'):
+            await self.authenticate(user, password)
+
+    async def authenticate(self, user, password):
+        methods = self.features.get('AUTH', '').upper().split()
+        if 'PLAIN' in methods or 'LOGIN' not in methods:
+            credentials = ('\0' + user + '\0' + password).encode('UTF-8')
+            (code, message) = await self.command('AUTH PLAIN ' + base64.b64encode(credentials).decode('ASCII'))
+        else:
+            (code, message) = await self.command('AUTH LOGIN')
+            if code == 334:
+                (code, message) = await self.command(base64.b64encode(user.encode('UTF-8')).decode('ASCII'))
+            if code == 334:
+                (code, message) = await self.command(base64.b64encode(password.encode('UTF-8')).decode('ASCII'))
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def sendmail(self, from_address, to_address, message):
+        with self.metrics.timed('smtp_command', 'sendmail'):
+            await self.send_message(from_address, to_address, message)
+
+    async def send_message(self, from_address, to_address, message):
+        (code, response) = await self.command('MAIL FROM:<' + from_address + '>')
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_address)
+        (code, response) = await self.command('RCPT TO:<' + to_address + '>')
+        if code not in (250, 251):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused({to_address: (code, response)})
+        (code, response) = await self.command('DATA')
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, response)
+        # escape lines starting with a dot, like smtplib does
+        data = re.sub(rb'(?m)^\.', b'..', message)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        self.metrics.count('smtp_bytes_sent', len(data) + 3)
+        self.writer.write(data + b'.\r\n')
+        (code, response) = await self.read_reply()
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+    async def rset(self):
+        try:
+            await self.command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def quit(self):
+        with self.metrics.timed('smtp_command', 'quit'):
+            try:
+                await self.command('QUIT')
+            except Exception:
+                pass
+        self.writer.close()
+
+    async def command(self, line):
+        data = line.encode('UTF-8') + b'\r\n'
+        self.metrics.count('smtp_bytes_sent', len(data))
+        self.writer.write(data)
+        return await self.read_reply()
+
+    async def read_reply(self):
+        lines = []
+        while True:
+            try:
+                line = await self.reader.readline()
+            except OSError as e:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed: " + str(e))
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            self.metrics.count('smtp_bytes_received', len(line))
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return (int(line[:3]), b'\n'.join(lines))
+
+
+def get_email_body(account, mail):
+    """Extract the body text from an email message."""
+    # Prefer plain text, attachments are skipped
+    part = get_body_part(mail.message, ('plain', 'html'))
+    if part is None:
+        return ''
+    body = get_text_content(part)
+    limit = account.config['request.body.max.length']
+    if part.get_content_type() == 'text/html':
+        return html_to_text(body, limit)
+    if limit:
+        body = body[:limit]
+    return body.strip()
+
+
+def get_body_part(part, preferencelist):
+    """Find the body of an email like EmailMessage.get_body() does, for messages parsed with the compat32 policy.
+
+    The header values of the modern email policy are parsed on every access, which would cost more than the rest of
+    processing an email.
+    """
+    best = None
+    for (priority, candidate) in find_body_parts(part, preferencelist):
+        if best is None or priority < best[0]:
+            best = (priority, candidate)
+    return None if best is None else best[1]
+
+
+def find_body_parts(part, preferencelist):
+    if part.get_content_disposition() == 'attachment':
+        return
+    (maintype, subtype) = part.get_content_type().split('/')
+    if maintype == 'text':
+        if subtype in preferencelist:
+            yield (preferencelist.index(subtype), part)
+    elif maintype == 'multipart' and part.is_multipart():
+        subparts = part.get_payload()
+        if subtype == 'related':
+            # only the start part of related parts is the body, the others are like its images
+            start = part.get_param('start')
+            subparts = [subpart for subpart in subparts if start and subpart['Content-ID'] == start] or subparts[:1]
+        for subpart in subparts:
+            yield from find_body_parts(subpart, preferencelist)
+
+
+def get_text_content(part):
+    """Decode a text part with its declared charset, without failing on wrong or unknown charsets."""
+    payload = part.get_payload(decode=True) or b''
+    try:
+        return payload.decode(part.get_content_charset('utf-8'), errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+def html_to_text(html_text, limit=0):
+    """Convert HTML to plain text in a single pass, stopping once the text is longer than limit if it is not 0."""
+    extractor = HTMLTextExtractor(limit)
+    for offset in range(0, len(html_text), 65536):
+        if extractor.is_full():
+            break
+        extractor.feed(html_text[offset:offset + 65536])
+    extractor.close()
+    return extractor.get_text()
+
+
+class HTMLTextExtractor(html.parser.HTMLParser):
+    """Collects the text of an HTML document, without scripts and styles and with entities unescaped."""
+
+    # tags whose content is not displayed
+    SKIPPED_TAGS = {'head', 'script', 'style', 'template', 'title'}
+    # tags that start or end a new line
+    BLOCK_TAGS = {'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer', 'form',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table',
+                  'td', 'th', 'tr', 'ul'}
+
+    def __init__(self, limit=0):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.skipped_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skipped_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.add_text('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skipped_depth = max(self.skipped_depth - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.add_text('\n')
+
+    def handle_data(self, data):
+        if not self.skipped_depth:
+            # line breaks in the HTML source are just spaces, like in a browser
+            self.add_text(' '.join(data.splitlines()))
+
+    def add_text(self, text):
+        if self.limit:
+            text = text[:self.limit - self.length]
+        self.parts.append(text)
+        self.length += len(text)
+
+    def is_full(self):
+        return self.limit and self.length >= self.limit
+
+    def get_text(self):
+        """Return the collected text with consecutive spaces collapsed and at most one empty line in a row."""
+        lines = []
+        for line in ''.join(self.parts).split('\n'):
+            line = ' '.join(line.split())
+            if line or (lines and lines[-1]):
+                lines.append(line)
+        return '\n'.join(lines).strip()
+
+
+def get_email_subject(mail):
+    return decode_header_value(mail.get('Subject', ''))
+
+
+def decode_header_value(value):
+    if not value or '=?' not in value:
+        return value or ''
+    decoded_value = ''
+    for part, encoding in email.header.decode_header(value):
+        if isinstance(part, bytes):
+            try:
+                # the text between encoded words is returned as raw-unicode-escape bytes
+                decoded_value += part.decode(encoding or 'raw-unicode-escape', errors='replace')
+            except LookupError:
+                decoded_value += part.decode('utf-8', errors='replace')
+        else:
+            decoded_value += str(part)
+    return decoded_value
+
+
+# Template variables that can be used in the subject and body of the reply, mapped to the functions computing them
+TEMPLATE_VARIABLES = {
+    'SUBJECT': lambda account, mail: get_email_subject(mail),
+    'BODY': get_email_body
+}
+# Matches the template variables in upper or lower case, like [SUBJECT] or [subject]
+TEMPLATE_VARIABLE_PATTERN = re.compile(
+    r'\[(' + '|'.join(re.escape(name) + '|' + re.escape(name.lower()) for name in TEMPLATE_VARIABLES) + r')\]')
+
+
+def compile_template(text):
+    """Split a template once into alternating literal text and variable names, so rendering is a single join."""
+    segments = TEMPLATE_VARIABLE_PATTERN.split(text)
+    for index in range(1, len(segments), 2):
+        segments[index] = segments[index].upper()
+    return segments
+
+
+def get_template_variable_names(template):
+    return set(template[1::2])
+
+
+def render_template(template, variables):
+    """Replace the variables of a compiled template with the values of the given TemplateVariables."""
+    return ''.join(segment if index % 2 == 0 else variables[segment] for (index, segment) in enumerate(template))
+
+
+class TemplateVariables(dict):
+    """The values of the template variables for one email, each computed only when it is first used."""
+
+    def __init__(self, account, mail):
+        super().__init__()
+        self.account = account
+        self.mail = mail
+
+    def __missing__(self, name):
+        value = self[name] = TEMPLATE_VARIABLES[name](self.account, self.mail)
+        return value
 
 
 def cast(obj, to_type, options=None):
@@ -435,51 +2591,146 @@ def cast(obj, to_type, options=None):
         return obj
 
 
-def shutdown_with_error(message):
-    message = "Error! " + str(message)
-    message += "\nCurrent configuration file path: '" + str(config_file_path) + "'."
-    if config is not None:
+def shutdown_with_error(account, message):
+    error = str(message)
+    message = "Error! " + error
+    message += "\nCurrent configuration file path: '" + str(account.config_file_path) + "'."
+    if account.config is not None:
         # Create a safe version of config without passwords
-        safe_config = config.copy()
+        safe_config = account.config.copy()
         if 'in.pw' in safe_config:
             safe_config['in.pw'] = '******'
         if 'out.pw' in safe_config:
             safe_config['out.pw'] = '******'
         message += "\nCurrent configuration: " + str(safe_config)
-    print(message)
-    shutdown(-1)
-
-
-def log_warning(message):
-    print("Warning! " + message)
-
-
-def log_debug(message):
-    if config and config.get('debug', False):
-        print("[DEBUG] " + message)
-
-
-def log_statistics():
-    if config.get('debug', False):
-        run_time = datetime.datetime.now() - statistics['start_time']
-        total_mails = statistics['mails_total']
-        loading_errors = statistics['mails_loading_error']
-        wrong_sender_count = statistics['mails_wrong_sender']
-        processing_errors = total_mails - statistics['mails_processed']
-        moving_errors = statistics['mails_processed'] - statistics['mails_in_trash'] - statistics['mails_wrong_sender']
-        total_warnings = loading_errors + processing_errors + moving_errors
-        message = "Executed "
-        message += "without warnings " if total_warnings == 0 else "with " + str(total_warnings) + " warnings "
-        message += "in " + str(run_time.total_seconds()) + " seconds. "
-        message += "Found " + str(total_mails) + " emails in inbox"
-        message += ". " if wrong_sender_count == 0 else " with " + str(wrong_sender_count) + " emails from wrong senders. "
-        message += "Processed " + str(statistics['mails_processed']) + \
-                   " emails, replied to " + str(total_mails - wrong_sender_count) + " emails. "
-        if total_warnings != 0:
-            message += "Encountered " + str(loading_errors) + " errors while loading emails, " + \
-                       str(processing_errors) + " errors while processing emails and " + \
-                       str(moving_errors) + " errors while moving emails to trash."
-        print(message)
+    print(account.log_prefix + message)
+    raise AccountError(error)
+
+
+def log_warning(account, message):
+    print(account.log_prefix + "Warning! " + message)
+
+
+def log_debug(account, message, *args):
+    """Print a debug message, formatted with the given arguments like 'message % args' only if debug is enabled."""
+    if account.config and account.config.get('debug', False):
+        print(account.log_prefix + "[DEBUG] " + (message % args if args else message))
+
+
+def reset_statistics(account):
+    account.statistics['start_time'] = datetime.datetime.now()
+    for key in account.statistics:
+        if key.startswith('mails_'):
+            account.statistics[key] = 0
+
+
+def log_statistics(account):
+    if account.config.get('debug', False):
+        print(account.log_prefix + get_statistics_message(account.statistics))
+
+
+def log_account_results(results):
+    """Print the accounts that failed in multi-account mode, the statistics have been printed by each account."""
+    for result in results:
+        if result['error']:
+            print("[" + result['account'] + "] Failed: " + result['error'])
+    failed_count = sum(1 for result in results if result['error'])
+    if failed_count:
+        print("Error! Processing failed for " + str(failed_count) + " of " + str(len(results)) + " accounts.")
+
+
+def write_metrics(account):
+    """Append the metrics of the run to the JSON lines file and replace the Prometheus textfile, if configured."""
+    if not account.config['metrics.file'] and not account.config['metrics.prometheus.file']:
+        return
+    record = get_metrics_record(account)
+    try:
+        if account.config['metrics.file']:
+            with open(account.config['metrics.file'], 'a', encoding='UTF-8') as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        if account.config['metrics.prometheus.file']:
+            # replaced at once, so the collector never reads a partly written file
+            temporary_file = account.config['metrics.prometheus.file'] + ".tmp"
+            with open(temporary_file, 'w', encoding='UTF-8') as f:
+                f.write(format_prometheus_metrics(record))
+            os.replace(temporary_file, account.config['metrics.prometheus.file'])
+    except OSError as e:
+        log_warning(account, "Could not write metrics. Reason: '" + str(e) + "'.")
+
+
+def get_metrics_record(account):
+    """Collect the metrics and the statistics of the run, like {"counters": {...}, "phase": {"fetch": {...}}}."""
+    (counters, histograms) = account.metrics.snapshot()
+    for (key, value) in account.statistics.items():
+        if key.startswith('mails_'):
+            counters[key] = value
+    record = {
+        'time': round(time.time(), 3),
+        'inbox': get_inbox_key(account),
+        'run_seconds': (datetime.datetime.now() - account.statistics['start_time']).total_seconds(),
+        'counters': counters
+    }
+    for name in METRICS_HISTOGRAMS:
+        record[name] = histograms.get(name, {})
+    return record
+
+
+def format_prometheus_metrics(record):
+    """Format a metrics record in the text format read by the textfile collector of the Prometheus node exporter."""
+    inbox_label = 'inbox="' + escape_prometheus_label(record['inbox']) + '"'
+    lines = ["# TYPE autoresponder_last_run_timestamp_seconds gauge",
+             "autoresponder_last_run_timestamp_seconds{" + inbox_label + "} " + str(record['time']),
+             "# TYPE autoresponder_last_run_duration_seconds gauge",
+             "autoresponder_last_run_duration_seconds{" + inbox_label + "} " + str(record['run_seconds'])]
+    # the values start from zero on every run and every pass of the daemon, so they are gauges of the last run
+    # rather than counters, and the number of emails found is not named like a counter
+    for (name, value) in sorted(record['counters'].items()):
+        metric = "autoresponder_last_run_" + ("mails_found" if name == "mails_total" else name)
+        lines.append("# TYPE " + metric + " gauge")
+        lines.append(metric + "{" + inbox_label + "} " + str(value))
+    # for the same reason, histograms are given as the number and the total duration of the phases and commands
+    for (name, label_name) in METRICS_HISTOGRAMS.items():
+        for (suffix, key) in (("_seconds", 'sum'), ("_count", 'count')):
+            metric = "autoresponder_last_run_" + name + suffix
+            lines.append("# TYPE " + metric + " gauge")
+            for (label, histogram) in sorted(record[name].items()):
+                labels = inbox_label + ',' + label_name + '="' + escape_prometheus_label(label) + '"'
+                lines.append(metric + "{" + labels + "} " + str(histogram[key]))
+    return "\n".join(lines) + "\n"
+
+
+def escape_prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_statistics_message(statistics):
+    run_time = datetime.datetime.now() - statistics['start_time']
+    total_mails = statistics['mails_total']
+    loading_errors = statistics['mails_loading_error']
+    wrong_sender_count = statistics['mails_wrong_sender']
+    processing_errors = total_mails - statistics['mails_processed']
+    sending_errors = statistics['mails_send_error']
+    moving_errors = statistics['mails_processed'] - statistics['mails_in_trash'] - statistics['mails_wrong_sender'] - \
+        sending_errors
+    total_warnings = loading_errors + processing_errors + sending_errors + moving_errors
+    message = "Executed "
+    message += "without warnings " if total_warnings == 0 else "with " + str(total_warnings) + " warnings "
+    message += "in " + str(run_time.total_seconds()) + " seconds. "
+    message += "Found " + str(total_mails) + " emails in inbox"
+    message += ". " if wrong_sender_count == 0 else " with " + str(wrong_sender_count) + " emails from wrong senders. "
+    message += "Processed " + str(statistics['mails_processed']) + " emails, replied to " + \
+               str(total_mails - wrong_sender_count - statistics['mails_suppressed'] -
+                   statistics['mails_replied_before'] - sending_errors) + " emails. "
+    if statistics['mails_suppressed'] != 0:
+        message += "Suppressed replies to " + str(statistics['mails_suppressed']) + " emails. "
+    if statistics['mails_replied_before'] != 0:
+        message += "Moved " + str(statistics['mails_replied_before']) + " emails replied to by an earlier run. "
+    if total_warnings != 0:
+        message += "Encountered " + str(loading_errors) + " errors while loading emails, " + \
+                   str(processing_errors) + " errors while processing emails, " + \
+                   str(sending_errors) + " errors while sending replies and " + \
+                   str(moving_errors) + " errors while moving emails to trash."
+    return message
 
 
 def display_help_text():
@@ -487,25 +2738,74 @@ def display_help_text():
     print("\t--help: Display this help information")
     print("\t--config-path <path/to/config/file>: "
           "Override path to config file (defaults to same directory as the script is)")
+    print("\t--daemon: Keep running and reply to new emails as soon as they arrive instead of exiting")
+    print("\t--async: Overlap downloading, replying and moving emails to trash using asyncio (needs Python 3.11, "
+          "not with --daemon)")
+    print("\t--config-path can be given several times and can name directories of config files to process "
+          "several accounts in parallel (not with --daemon):")
+    print("\t\t--workers <number>: Number of accounts to process at the same time (defaults to " +
+          str(DEFAULT_WORKERS) + ")")
+    print("\t\t--processes: Process the accounts in separate processes instead of threads")
     exit(0)
 
 
-def shutdown(error_code):
-    if incoming_mail_server is not None:
+def shutdown(account):
+    stop_delivery_workers(account)
+    try:
+        # replies sent before an error or an interrupt are journaled, so they are not sent again on the next run
+        handle_delivered_replies(account)
+        if account.state_database is not None:
+            account.state_database.commit()
+    except sqlite3.Error as e:
+        log_warning(account, "Could not journal the sent replies. Reason: '" + str(e) + "'.")
+    disconnect_from_mail_servers(account)
+    if account.state_database is not None:
+        account.state_database.close()
+
+
+def disconnect_from_mail_servers(account):
+    disconnect_from_imap(account)
+    stop_delivery_workers(account)
+    for index in range(len(account.outgoing_mail_servers)):
+        disconnect_from_smtp(account, index)
+
+
+def stop_delivery_workers(account):
+    # replies whose sending has not started yet are dropped, their emails stay in the inbox for the next run
+    while account.delivery_queue is not None:
         try:
-            incoming_mail_server.close()
+            (mail, receiver_email, message) = account.delivery_queue.get_nowait()
+        except queue.Empty:
+            break
+        account.delivery_results.put((mail, receiver_email, get_stopped_failure()))
+        account.delivery_queue.task_done()
+    for worker in account.delivery_workers:
+        account.delivery_queue.put(None)
+    for worker in account.delivery_workers:
+        worker.join()
+    account.delivery_workers.clear()
+
+
+def disconnect_from_smtp(account, index):
+    if account.outgoing_mail_servers[index] is not None:
+        try:
+            account.outgoing_mail_servers[index].quit()
         except Exception:
             pass
+        account.outgoing_mail_servers[index] = None
+
+
+def disconnect_from_imap(account):
+    if account.incoming_mail_server is not None:
         try:
-            incoming_mail_server.logout()
+            account.incoming_mail_server.close()
         except Exception:
             pass
-    if outgoing_mail_server is not None:
         try:
-            outgoing_mail_server.quit()
+            account.incoming_mail_server.logout()
         except Exception:
             pass
-    exit(error_code)
 
 
-run()
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,321 @@
+import email.message
+import email.policy
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark_autoresponder as benchmark
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "run_autoresponder.py")
+
+
+class AutoresponderTest(unittest.TestCase):
+    """Runs run_autoresponder.py against the stand-in servers of the benchmark."""
+
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.NamedTemporaryFile('w', suffix=".pem", delete=False) as f:
+            f.write(benchmark.CERTIFICATE)
+        cls.certificate_file = f.name
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.certificate_file)
+
+    def setUp(self):
+        self.imap_server = benchmark.StandInIMAPServer(self.certificate_file, 0)
+        self.smtp_server = benchmark.StandInSMTPServer(self.certificate_file, 0)
+        self.addCleanup(self.imap_server.stop)
+        self.addCleanup(self.smtp_server.stop)
+        # the state file next to the configuration is kept between the runs of a test
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        self.config_file_path = os.path.join(config_dir.name, "autoresponder.config.ini")
+        self.config = benchmark.CONFIG_TEMPLATE.format(imap_port=self.imap_server.port,
+                                                       smtp_port=self.smtp_server.port, smtp_connections=2)
+
+    def run_autoresponder(self, *arguments):
+        with open(self.config_file_path, 'w', encoding='UTF-8') as f:
+            f.write(self.config)
+        return subprocess.run([sys.executable, SCRIPT, "--config-path", self.config_file_path] + list(arguments),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60, encoding='UTF-8')
+
+    def reset_servers(self):
+        """Empty the folders and the received messages, and forget the state, to run the same test again."""
+        self.imap_server.folders = {'Inbox': [], 'Trash': []}
+        self.smtp_server.messages = []
+        state_file_path = os.path.join(os.path.dirname(self.config_file_path), "autoresponder.state.sqlite")
+        if os.path.exists(state_file_path):
+            os.remove(state_file_path)
+
+    def test_email_without_sender(self):
+        message = email.message.EmailMessage(policy=email.policy.SMTP)
+        message['To'] = "support@example.com"
+        message['Subject'] = "No sender"
+        message.set_content("This email has no From header.")
+        for engine in ([], ["--async"]):
+            with self.subTest(engine=engine):
+                self.reset_servers()
+                self.imap_server.append('Inbox', message.as_bytes())
+                self.imap_server.append('Inbox', benchmark.generate_email(1, 500, True))
+                result = self.run_autoresponder(*engine)
+                self.assertEqual(result.returncode, 0, result.stdout)
+                self.assertIn("Unexpected error while processing email", result.stdout)
+                # the other email is still replied to, the one without sender stays in the inbox
+                self.assertEqual(len(self.smtp_server.messages), 1)
+                self.assertEqual(len(self.imap_server.folders['Trash']), 1)
+                self.assertEqual([raw for (uid, raw, deleted) in self.imap_server.folders['Inbox']],
+                                 [message.as_bytes()])
+
+    def test_failing_email_is_retried_a_limited_number_of_times(self):
+        self.config = self.config.replace("debug = false", "debug = true\nemail.retries = 1")
+        message = email.message.EmailMessage(policy=email.policy.SMTP)
+        message['To'] = "support@example.com"
+        message['Subject'] = "No sender"
+        message.set_content("This email has no From header.")
+        self.imap_server.append('Inbox', message.as_bytes())
+        outputs = []
+        for index in range(3):
+            self.imap_server.append('Inbox', benchmark.generate_email(index, 500, True))
+            result = self.run_autoresponder()
+            self.assertEqual(result.returncode, 0, result.stdout)
+            outputs.append(result.stdout)
+        # the failing email doesn't keep the later runs from skipping the emails examined before
+        self.assertIn("Found 2 new emails in inbox", outputs[0])
+        self.assertIn("Found 1 new emails in inbox", outputs[1])
+        self.assertIn("Examining 1 emails again", outputs[1])
+        self.assertIn("Giving up on email with UID '1'", outputs[1])
+        self.assertIn("Found 1 new emails in inbox", outputs[2])
+        self.assertNotIn("Examining", outputs[2])
+        self.assertEqual(len(self.smtp_server.messages), 3)
+        self.assertEqual([raw for (uid, raw, deleted) in self.imap_server.folders['Inbox']], [message.as_bytes()])
+
+    def test_one_reply_per_sender_within_suppression_ttl(self):
+        self.config = self.config.replace("[mail content settings]",
+                                          "[mail content settings]\nmail.reply.suppression.ttl = 3600")
+        for engine in ([], ["--async"]):
+            with self.subTest(engine=engine):
+                self.reset_servers()
+                for index in range(3):
+                    message = email.message.EmailMessage(policy=email.policy.SMTP)
+                    message['From'] = "Anna Schmidt <anna@partner.example>"
+                    message['To'] = "support@example.com"
+                    message['Subject'] = "Question " + str(index)
+                    message.set_content("Another question.")
+                    self.imap_server.append('Inbox', message.as_bytes())
+                self.imap_server.append('Inbox', benchmark.generate_email(1, 500, True))
+                result = self.run_autoresponder(*engine)
+                self.assertEqual(result.returncode, 0, result.stdout)
+                # the emails of the same sender are handled while the first reply is still being sent
+                self.assertEqual(len(self.smtp_server.messages), 2)
+                self.assertEqual(len(self.imap_server.folders['Trash']), 4)
+
+    def test_lost_imap_connection(self):
+        self.config = self.config.replace("[mail server settings]",
+                                          "[mail server settings]\nmailserver.incoming.fetch.chunk.size = 2")
+        # the replies to the first chunk are still being sent when the connection is lost
+        self.smtp_server.latency = 0.2
+        for engine in ([], ["--async"]):
+            with self.subTest(engine=engine):
+                self.reset_servers()
+                for index in range(6):
+                    self.imap_server.append('Inbox', benchmark.generate_email(index, 500, True))
+                self.imap_server.RequestHandlerClass = ConnectionDroppingIMAPHandler
+                result = self.run_autoresponder(*engine)
+                self.assertNotEqual(result.returncode, 0, result.stdout)
+                # the replies being sent are finished and journaled before the run stops
+                self.assertEqual(len(self.smtp_server.messages), 2)
+                self.imap_server.RequestHandlerClass = benchmark.IMAPHandler
+                result = self.run_autoresponder(*engine)
+                self.assertEqual(result.returncode, 0, result.stdout)
+                recipients = [email.message_from_bytes(raw)['To'] for raw in self.smtp_server.messages]
+                self.assertEqual(len(recipients), 6)
+                self.assertEqual(len(set(recipients)), 6)
+
+    def test_killed_run(self):
+        self.smtp_server.latency = 0.1
+        for engine in ([], ["--async"]):
+            with self.subTest(engine=engine):
+                self.reset_servers()
+                for index in range(8):
+                    self.imap_server.append('Inbox', benchmark.generate_email(index, 500, True))
+                with open(self.config_file_path, 'w', encoding='UTF-8') as f:
+                    f.write(self.config)
+                process = subprocess.Popen([sys.executable, SCRIPT, "--config-path", self.config_file_path] + engine,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                self.addCleanup(process.kill)
+                deadline = time.monotonic() + 30
+                while not self.smtp_server.messages and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                process.kill()
+                process.wait()
+                self.assertTrue(self.smtp_server.messages)
+                result = self.run_autoresponder(*engine)
+                self.assertEqual(result.returncode, 0, result.stdout)
+                # replies that were being sent are not sent again, even if they have not been delivered
+                recipients = [email.message_from_bytes(raw)['To'] for raw in self.smtp_server.messages]
+                self.assertEqual(len(recipients), len(set(recipients)))
+                self.assertEqual(len(self.imap_server.folders['Inbox']), 0)
+
+    def test_interrupted_run(self):
+        self.smtp_server.latency = 0.1
+        for engine in ([], ["--async"]):
+            with self.subTest(engine=engine):
+                self.reset_servers()
+                for index in range(8):
+                    self.imap_server.append('Inbox', benchmark.generate_email(index, 500, True))
+                with open(self.config_file_path, 'w', encoding='UTF-8') as f:
+                    f.write(self.config)
+                process = subprocess.Popen([sys.executable, SCRIPT, "--config-path", self.config_file_path] + engine,
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
+                self.addCleanup(process.kill)
+                deadline = time.monotonic() + 30
+                while not self.smtp_server.messages and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                process.send_signal(signal.SIGINT)
+                output = process.communicate(timeout=60)[0]
+                self.assertNotEqual(process.returncode, 0, output)
+                self.assertLess(len(self.smtp_server.messages), 8)
+                # the replies being sent have been finished and journaled, the others are sent by the next run
+                result = self.run_autoresponder(*engine)
+                self.assertEqual(result.returncode, 0, result.stdout)
+                recipients = [email.message_from_bytes(raw)['To'] for raw in self.smtp_server.messages]
+                self.assertEqual(len(recipients), 8)
+                self.assertEqual(len(set(recipients)), 8)
+                self.assertEqual(len(self.imap_server.folders['Inbox']), 0)
+
+    def test_daemon(self):
+        self.config = self.config.replace("debug = false", "debug = false\ndaemon.poll.interval = 1")
+        self.imap_server.RequestHandlerClass = NotifyingIMAPHandler
+        self.imap_server.append('Inbox', benchmark.generate_email(0, 500, True))
+        with open(self.config_file_path, 'w', encoding='UTF-8') as f:
+            f.write(self.config)
+        process = subprocess.Popen([sys.executable, SCRIPT, "--config-path", self.config_file_path, "--daemon"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
+        self.addCleanup(process.kill)
+        deadline = time.monotonic() + 30
+        while len(self.smtp_server.messages) < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # emails arriving later are replied to by the running daemon
+        self.imap_server.append('Inbox', benchmark.generate_email(1, 500, True))
+        deadline = time.monotonic() + 30
+        while len(self.smtp_server.messages) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        process.send_signal(signal.SIGTERM)
+        output = process.communicate(timeout=60)[0]
+        self.assertEqual(process.returncode, 0, output)
+        self.assertEqual(len(self.smtp_server.messages), 2)
+        self.assertEqual(len(self.imap_server.folders['Trash']), 2)
+
+    def test_sender_rules_that_cannot_be_combined(self):
+        self.config = self.config.replace("[mail content settings]",
+                                          "[mail content settings]\nmail.request.from.rules = /(?P<a>x)/, /(?P<a>y)/")
+        result = self.run_autoresponder()
+        self.assertNotEqual(result.returncode, 0, result.stdout)
+        self.assertIn("can't be combined", result.stdout)
+        self.assertEqual(len(self.smtp_server.messages), 0)
+
+    def test_invalid_reply_address(self):
+        message = email.message.EmailMessage(policy=email.policy.SMTP)
+        message['From'] = "Anna Schmidt <anna@partner.example>"
+        message['Reply-To'] = "nobody"
+        message['To'] = "support@example.com"
+        message['Subject'] = "No valid reply address"
+        message.set_content("The Reply-To of this email is not an address.")
+        self.imap_server.append('Inbox', message.as_bytes())
+        result = self.run_autoresponder()
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn("invalid recipient address", result.stdout)
+        # a reply is never possible, so the email is moved to trash without one
+        self.assertEqual(len(self.smtp_server.messages), 0)
+        self.assertEqual(len(self.imap_server.folders['Trash']), 1)
+
+    def test_refused_sender_address(self):
+        self.smtp_server.RequestHandlerClass = SenderRefusingSMTPHandler
+        for index in range(2):
+            self.imap_server.append('Inbox', benchmark.generate_email(index, 500, True))
+        result = self.run_autoresponder()
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn("Sender address rejected", result.stdout)
+        self.assertNotIn("invalid recipient address", result.stdout)
+        # the emails stay in the inbox until the reply can be sent
+        self.assertEqual(len(self.imap_server.folders['Inbox']), 2)
+        self.assertEqual(len(self.imap_server.folders['Trash']), 0)
+
+    def test_failed_store(self):
+        self.imap_server.RequestHandlerClass = StoreFailingIMAPHandler
+        for index in range(3):
+            self.imap_server.append('Inbox', benchmark.generate_email(index, 500, True))
+        result = self.run_autoresponder()
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertIn("Moving emails to trash failed at STORE", result.stdout)
+        self.assertEqual(len(self.imap_server.folders['Inbox']), 3)
+        # the emails are only moved on the next run, without replying again
+        self.imap_server.RequestHandlerClass = benchmark.IMAPHandler
+        result = self.run_autoresponder()
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(len(self.imap_server.folders['Inbox']), 0)
+        self.assertEqual(len(self.smtp_server.messages), 3)
+
+
+class StoreFailingIMAPHandler(benchmark.IMAPHandler):
+    """Refuses to flag emails, the fallback of copying them to trash instead of moving them fails."""
+
+    CAPABILITIES = "IMAP4rev1 UIDPLUS"
+
+    def send(self, data):
+        super().send(data.replace(b" OK STORE completed", b" NO STORE failed"))
+
+
+class ConnectionDroppingIMAPHandler(benchmark.IMAPHandler):
+    """Drops the connection when the headers of the second chunk of emails are downloaded."""
+
+    header_fetches = 0
+
+    def read_command(self):
+        line = super().read_command()
+        if line is not None and 'HEADER.FIELDS' in line.upper():
+            self.header_fetches += 1
+            if self.header_fetches == 2:
+                return None
+        return line
+
+
+class NotifyingIMAPHandler(benchmark.IMAPHandler):
+    """Reports new emails in the selected folder on NOOP, like real servers do."""
+
+    reported = None
+
+    def dispatch(self, command, arguments, uid):
+        response = super().dispatch(command, arguments, uid)
+        if command in ('SELECT', 'NOOP') and self.selected is not None:
+            next_uid = self.server.next_uid[self.selected]
+            if command == 'NOOP' and next_uid != self.reported:
+                response += b"* " + str(len(self.server.folders[self.selected])).encode() + b" EXISTS\r\n"
+            self.reported = next_uid
+        return response
+
+
+class SenderRefusingSMTPHandler(benchmark.SMTPHandler):
+    """Refuses the sender address of every email with a permanent error."""
+
+    command = None
+
+    def read_command(self):
+        self.command = super().read_command()
+        return self.command
+
+    def send(self, data):
+        if self.command and self.command.upper().startswith('MAIL'):
+            data = b"550 Sender address rejected\r\n"
+        super().send(data)
+
+
+if __name__ == "__main__":
+    unittest.main()